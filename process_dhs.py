@@ -1,14 +1,24 @@
 import os
+import time
+import argparse
+import traceback
+from itertools import islice
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
 
 import pandas as pd
 import geopandas as gpd
 from math import isnan
 
 import src.process_IWI as iwi
-from src.utils import area_of_interest
+from src.utils import areas_of_interest
 import pyreadstat
 
 from src.process_IWI import read_petterson, read_sustain_bench, get_all_aoi
+from src.manifest import Manifest, file_state
+from src.dhs_reader import read_survey
+from src.store import write_table, read_table, concat_files
+from src.profiling import NULL_RECORD, Profiler
 
 
 # this script takes corresponding DHS survey .DTA and .shp files as input.
@@ -19,15 +29,7 @@ from src.process_IWI import read_petterson, read_sustain_bench, get_all_aoi
 # query GEE for accompanying satellite imagery.
 
 
-def main(folder_path, country, year, buffer):
-    output_path = os.path.join(os.getcwd(), "data", "dhs_month")
-
-    if not os.path.exists(output_path):
-        print(f'creating {output_path}')
-        os.makedirs(output_path)
-
-    folder = os.path.join(folder_path, year)
-
+def find_survey_files(folder):
     dhs_survey = None
     dhs_gps = None
     dhs_iwi = None
@@ -43,6 +45,35 @@ def main(folder_path, country, year, buffer):
             dhs_iwi = os.path.join(folder, file_name)
             print("dhs_iwi:", file_name)
 
+    return dhs_survey, dhs_gps, dhs_iwi
+
+
+def survey_inputs(folder):
+    """
+    Files main reads for a survey folder: the .DTA, .sav and the
+    shapefile with its sidecar files.
+    """
+    dhs_survey, dhs_gps, dhs_iwi = find_survey_files(folder)
+    inputs = [path for path in (dhs_survey, dhs_iwi) if path]
+
+    if dhs_gps:
+        stem = os.path.splitext(dhs_gps)[0]
+        inputs += [stem + ext for ext in ('.shp', '.shx', '.dbf', '.prj', '.cpg') if os.path.exists(stem + ext)]
+
+    return sorted(inputs)
+
+
+def main(folder_path, country, year, buffer, csv=False, record=NULL_RECORD):
+    output_path = os.path.join(os.getcwd(), "data", "dhs_month")
+
+    if not os.path.exists(output_path):
+        print(f'creating {output_path}')
+        os.makedirs(output_path)
+
+    folder = os.path.join(folder_path, year)
+
+    dhs_survey, dhs_gps, dhs_iwi = find_survey_files(folder)
+
     if not dhs_survey or not dhs_gps or not dhs_iwi:
         print(f"Skipping {folder}")
         return
@@ -51,7 +82,8 @@ def main(folder_path, country, year, buffer):
     # Process DHS survey file, extract mean wealth index for each cluster
     #####################################################################
 
-    df_survey = pd.read_stata(dhs_survey, convert_categoricals=False)
+    with record.stage('dhs_read'):
+        df_survey = read_survey(dhs_survey)
     df_survey['country'] = country
     df_survey = (df_survey[['country', 'hv006', 'hv007', 'hhid', 'hv001', 'hv025']]
                  .rename(columns={'hv006': 'month',
@@ -73,21 +105,23 @@ def main(folder_path, country, year, buffer):
     # Process DHS shapefile, extract cluster long, lat
     ##################################################
 
-    df_geo = (gpd.read_file(dhs_gps)[['DHSCLUST', 'LATNUM', 'LONGNUM']]
-              .rename(columns={'DHSCLUST': 'cluster_id',
-                               'LATNUM': 'lat',
-                               'LONGNUM': 'lon'}))
+    with record.stage('dhs_read'):
+        df_geo = (gpd.read_file(dhs_gps)[['DHSCLUST', 'LATNUM', 'LONGNUM']]
+                  .rename(columns={'DHSCLUST': 'cluster_id',
+                                   'LATNUM': 'lat',
+                                   'LONGNUM': 'lon'}))
 
-    # merge cluster wealth index and location information
-    dhs_geo = pd.merge(df_survey, df_geo, on='cluster_id', how='inner')
+    with record.stage('aoi'):
+        # merge cluster wealth index and location information
+        dhs_geo = pd.merge(df_survey, df_geo, on='cluster_id', how='inner')
 
-    # calculate area of interest coordinates
-    dhs_geo['area_of_interest'] = dhs_geo.apply(lambda x: area_of_interest(x['lat'],
-                                                                           x['lon'],
-                                                                           buffer),
-                                                axis=1)
+        # calculate area of interest coordinates
+        dhs_geo['area_of_interest'] = areas_of_interest(dhs_geo['lat'].values,
+                                                        dhs_geo['lon'].values,
+                                                        buffer).tolist()
 
-    dhs_geo.to_csv(os.path.join(output_path, f'geo_survey/{country}_{year}_cluster_wealth.csv'), index=False, sep=';')
+    with record.stage('write'):
+        write_table(dhs_geo, os.path.join(output_path, 'geo_survey', f'{country}_{year}_cluster_wealth'), csv=csv)
 
     print('Generated bounding box area of interest around each cluster.')
 
@@ -95,43 +129,221 @@ def main(folder_path, country, year, buffer):
     # Add IWI to the dataset
     ########################
 
-    if dhs_iwi:
-        output = iwi.get_IWI_global(dhs_geo, dhs_iwi)
-    else:
-        output = iwi.get_IWI_petterson(dhs_geo)
-
-    output_dest = os.path.join(os.getcwd(), "data", "dhs_month", f'{country}_{year}.csv')
+    with record.stage('iwi_join'):
+        if dhs_iwi:
+            output = iwi.get_IWI_global(dhs_geo, dhs_iwi)
+        else:
+            output = iwi.get_IWI_petterson(dhs_geo)
 
-    output.to_csv(output_dest, index=False, sep=';')
+    with record.stage('write'):
+        write_table(output, os.path.join(output_path, f'{country}_{year}'), csv=csv)
     print('successfully processed DHS information')
 
     return output
 
 
-def process_all_dhs_files(buffer=5):
-    for folder_name in os.listdir('data'):
+def process_survey(folder_path, country, year, buffer=5, csv=False, profile=None):
+    """
+    Run main on one survey folder, in a worker process. Returns a result
+    dict (key, status, output, rows, seconds, error) instead of raising,
+    status being 'done', 'skipped' (incomplete folder) or 'failed'.
+    profile: JSON lines file the stage timings are appended to.
+    """
+    result = {'key': f'{country}/{year}', 'status': 'done', 'output': None, 'rows': 0, 'error': None}
+    start = time.perf_counter()
+    record = Profiler(profile).record('survey', country=country, year=year)
+
+    try:
+        output = main(folder_path, country, year, buffer, csv, record)
+    except Exception:
+        output = None
+        result['status'] = 'failed'
+        result['error'] = traceback.format_exc()
+
+    if output is None and result['status'] == 'done':
+        result['status'] = 'skipped'
+    elif output is not None:
+        result['output'] = os.path.join('data', 'dhs_month', f'{country}_{year}.parquet')
+        result['rows'] = len(output)
+
+    result['seconds'] = time.perf_counter() - start
+    record.emit(status=result['status'], rows=result['rows'])
+    return result
+
+
+def process_all_dhs_files(buffer=5, force=False, csv=False, workers=1, profile=None):
+    """
+    Run main on every data/<country>/<year> survey folder whose input
+    files or parameters changed since the last run, according to the
+    manifest in data/dhs_month, with `workers` processes. Surveys are
+    independent, each one writes its own output and only this process
+    updates the manifest.
+
+    Returns the result of every out of date survey (see process_survey),
+    sorted by key. Failures are reported with their traceback and don't
+    stop the other surveys. A worker process dying fails the surveys it
+    was running and the pool is started again for the others. With profile, the stages of every survey are
+    recorded to that JSON lines file (see profiling).
+    """
+    manifest = Manifest(os.path.join('data', 'dhs_month', 'manifest.json'))
+    # the csv export is an output too: a survey processed without it is out of date with csv
+    params = {'buffer': buffer, 'format': 'parquet', 'csv': csv}
+
+    surveys = []
+    for folder_name in sorted(os.listdir('data')):
         folder_path = os.path.join('data', folder_name)
-        if os.path.isdir(folder_path):
-            for subfolder_name in os.listdir(folder_path):
-                try:
-                    main(folder_path, folder_name, subfolder_name, buffer)
-                except Exception as e:
-                    print(f'Error processing {folder_path}/{subfolder_name}: {e}')
+        # data/dhs_month holds the outputs, not surveys
+        if os.path.isdir(folder_path) and folder_name != 'dhs_month':
+            for subfolder_name in sorted(os.listdir(folder_path)):
+                folder = os.path.join(folder_path, subfolder_name)
+                if not os.path.isdir(folder):
                     continue
 
+                key = f'{folder_name}/{subfolder_name}'
+                inputs = survey_inputs(folder)
+                if not force and manifest.is_current(key, inputs, params):
+                    print(f'{key} is up to date')
+                    continue
 
-def build_global_data_lab_only(folder_path):
-    output = pd.DataFrame([])
-    print(output)
-    for file in os.listdir(folder_path):
-        if file.endswith('.csv'):
-            df = pd.read_csv(os.path.join(folder_path, file), sep=';')
-            output = pd.concat([output, df])
-            output = output[output['lat']!=0]
-    output.to_csv(os.path.join(folder_path, 'global_data_lab.csv'), sep=';', index=False)
+                surveys.append((folder_path, folder_name, subfolder_name, inputs))
+
+    # surveys without an IWI file are joined to the Pettersson clusters, parsed once here and cached for the workers
+    if surveys:
+        iwi.LABELS.warm('dhs_clusters')
+
+    results = []
+
+    def record(result, inputs):
+        if result['status'] == 'done':
+            outputs = [result['output']]
+            if csv:
+                outputs.append(result['output'].replace('.parquet', '.csv'))
+            manifest.record(result['key'], inputs, params, outputs=outputs)
+            manifest.save()
+        elif result['status'] == 'failed':
+            print(f"Error processing {result['key']}:\n{result['error']}")
+        results.append(result)
+
+    if workers > 1:
+        waiting = iter(surveys)
+        executor = ProcessPoolExecutor(max_workers=workers)
+        running = {}
+        try:
+            while True:
+                # one survey per worker at a time, so a worker dying (killed when out of memory...) only fails those
+                for folder_path, country, year, inputs in islice(waiting, workers - len(running)):
+                    future = executor.submit(process_survey, folder_path, country, year, buffer, csv, profile)
+                    running[future] = (executor, country, year, inputs)
+                if not running:
+                    break
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    pool, country, year, inputs = running.pop(future)
+                    try:
+                        result = future.result()
+                    except BrokenProcessPool as e:
+                        result = {'key': f'{country}/{year}', 'status': 'failed', 'output': None, 'rows': 0,
+                                  'error': f'Worker process died: {e}', 'seconds': 0.0}
+                        if pool is executor:
+                            executor.shutdown(wait=False)
+                            executor = ProcessPoolExecutor(max_workers=workers)
+                    record(result, inputs)
+        finally:
+            executor.shutdown()
+    else:
+        for folder_path, country, year, inputs in surveys:
+            record(process_survey(folder_path, country, year, buffer, csv, profile), inputs)
+
+    results.sort(key=lambda result: result['key'])
+
+    counts = {status: sum(result['status'] == status for result in results) for status in ('done', 'skipped', 'failed')}
+    print(f'Processed {len(results)} surveys with {workers} workers: {counts}')
+    if profile:
+        print(Profiler(profile).summary())
+
+    return results
+
+
+def read_survey_output(path):
+    """
+    Survey output of main without the clusters missing a location.
+    """
+    df = pd.read_parquet(path)
+    return df[df['lat'] != 0]
+
+
+def build_global_data_lab_only(folder_path, output_name='global_data_lab', csv=False, workers=1, chunked=False,
+                               output_dir=None):
+    """
+    Concatenate the per survey parquet files of folder_path, in file name
+    order, into output_name.parquet (and output_name.csv with csv) of
+    output_dir, folder_path by default. The rows each file contributed are
+    recorded in a manifest so only new or changed files are read again,
+    `workers` at a time, unchanged ones are taken back from the previous
+    output.
+
+    chunked: append the files to the output one at a time instead, so the
+    whole table never has to fit in memory. Every file is read again.
+    """
+    output = os.path.join(output_dir or folder_path, output_name)
+    output_path = f'{output}.parquet'
+    manifest = Manifest(f'{output}.manifest.json')
+    previous = manifest.entries.get(output_name) if os.path.exists(output_path) else None
+
+    files = sorted(file for file in os.listdir(folder_path)
+                   if file.endswith('.parquet') and file != f'{output_name}.parquet')
+    inputs = [os.path.join(folder_path, file) for file in files]
+
+    if chunked:
+        rows = concat_files(inputs, output, read_survey_output, csv)
+        manifest.record(output_name, inputs, outputs=[output_path], order=files, rows=dict(zip(files, rows)))
+        manifest.save()
+        return
 
+    segments = {}
+    if previous:
+        existing = read_table(output)
+        start = 0
+        for file in previous['order']:
+            rows = previous['rows'][file]
+            segments[file] = existing.iloc[start:start + rows]
+            start += rows
 
+    changed = [path for file, path in zip(files, inputs)
+               if not (previous and file in segments
+                       and file_state(path, previous['inputs'].get(path))['sha1'] == previous['inputs'][path]['sha1'])]
+    for path in changed:
+        print(f'merging {os.path.basename(path)}')
 
-if __name__ == '__main__':
-    get_all_aoi(5)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        segments.update(zip(map(os.path.basename, changed), executor.map(read_survey_output, changed)))
+
+    parts = [segments[file] for file in files]
+    rows = {file: len(part) for file, part in zip(files, parts)}
 
+    table = pd.concat(parts, ignore_index=True) if parts else pd.DataFrame([])
+    write_table(table, output, csv=csv)
+
+    manifest.record(output_name, inputs, outputs=[output_path], order=files, rows=rows)
+    manifest.save()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--surveys', action='store_true',
+                        help='process the out of date data/<country>/<year> survey folders first')
+    parser.add_argument('--workers', type=int, default=1, help='processes used for the surveys')
+    parser.add_argument('--force', action='store_true', help='process every survey folder')
+    parser.add_argument('--buffer', type=int, default=5, help='area of interest buffer in km')
+    parser.add_argument('--csv', action='store_true', help="also export ';' separated csv files")
+    parser.add_argument('--profile', help='JSON lines file to record the stage timings to')
+    args = parser.parse_args()
+
+    if args.surveys:
+        process_all_dhs_files(args.buffer, args.force, args.csv, args.workers, args.profile)
+        # data/global_data_lab, read by get_all_aoi
+        build_global_data_lab_only(os.path.join('data', 'dhs_month'), csv=args.csv, workers=args.workers,
+                                   output_dir='data')
+
+    get_all_aoi(args.buffer, args.csv, profile=args.profile)
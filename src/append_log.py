@@ -0,0 +1,58 @@
+import csv
+import os
+
+
+# Append-only ';' separated files (the JobLedger, the TileCatalog): a
+# header line, then one line per change, the last line of a key winning
+# when the file is read back. Lines are fsynced as they are appended, a
+# line cut short by a crash is skipped on reading and terminated so the
+# next one doesn't run into it.
+
+
+def load(path, columns, parse):
+    """
+    Rows of path parsed by parse(row), None for a line cut short by a
+    crash, in file order. A missing file is created with the header.
+    """
+    if not os.path.exists(path):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(path, 'w', newline='') as f:
+            csv.writer(f, delimiter=';').writerow(columns)
+        return []
+
+    rows = []
+    with open(path, newline='') as f:
+        for row in csv.DictReader(f, delimiter=';'):
+            # missing trailing fields are None, extra ones under the None key
+            if None in row or any(row.get(column) is None for column in columns):
+                continue
+            row = parse(row)
+            if row is not None:
+                rows.append(row)
+    end_line(path)
+
+    return rows
+
+
+def append(path, columns, rows):
+    with open(path, 'a', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=columns, delimiter=';')
+        writer.writerows(rows)
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def end_line(path):
+    """
+    Terminate the last line of path if a crash cut it short, so the next
+    appended line doesn't run into it.
+    """
+    with open(path, 'rb+') as f:
+        f.seek(0, os.SEEK_END)
+        if f.tell() == 0:
+            return
+        f.seek(-1, os.SEEK_END)
+        if f.read(1) != b'\n':
+            f.write(b'\r\n')
@@ -0,0 +1,318 @@
+import os
+import json
+import time
+import argparse
+import tempfile
+import subprocess
+from datetime import datetime
+from contextlib import contextmanager, redirect_stdout
+
+import numpy as np
+import pandas as pd
+
+from src.compute_IWI import score_iwi, score_iwi_rowwise, add_iwi
+from src.process_IWI import number_missing_clusters, number_missing_clusters_rowwise, get_all_aoi
+from src.utils import areas_of_interest
+from src import synthetic, store
+
+
+# Benchmarks of the vectorized pipeline steps against their row-wise
+# reference implementations, run on synthetic data so no DHS account
+# or network access is needed.
+
+
+def timed(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - start
+
+
+def benchmark_iwi(n=1_000_000, seed=0):
+    households = synthetic.households(n, seed)
+
+    vectorized_time = timed(score_iwi, households.copy())[1]
+    print(f'score_iwi: {n} households in {vectorized_time:.2f}s')
+
+    rowwise_time = timed(score_iwi_rowwise, households.copy())[1]
+    print(f'score_iwi_rowwise: {n} households in {rowwise_time:.2f}s')
+
+    print(f'speedup: {rowwise_time / vectorized_time:.1f}x')
+
+    return {'n': n, 'vectorized': vectorized_time, 'rowwise': rowwise_time}
+
+
+def synthetic_cluster_ids(n, missing=0.5, seed=0):
+    """
+    cluster_id column of the merged label sources: DHS ids with runs of
+    missing ids of random length, including leading and trailing runs.
+    """
+    rng = np.random.default_rng(seed)
+    ids = rng.integers(1, 1000, n).astype(float)
+    ids[rng.random(n) < missing] = np.nan
+    ids[:3] = ids[-3:] = np.nan
+    return pd.Series(ids, name='cluster_id')
+
+
+def benchmark_cluster_ids(n=100_000, seed=0):
+    cluster_ids = synthetic_cluster_ids(n, seed=seed)
+
+    vectorized_time = timed(number_missing_clusters, cluster_ids)[1]
+    print(f'number_missing_clusters: {n} rows in {vectorized_time:.4f}s')
+
+    rowwise_time = timed(number_missing_clusters_rowwise, cluster_ids)[1]
+    print(f'number_missing_clusters_rowwise: {n} rows in {rowwise_time:.4f}s')
+
+    print(f'speedup: {rowwise_time / vectorized_time:.1f}x')
+
+    return {'n': n, 'vectorized': vectorized_time, 'rowwise': rowwise_time}
+
+
+# Pipeline benchmarks on synthetic inputs, at several scales, with the
+# results appended to a JSON lines file tagged with the git commit so two
+# commits can be compared.
+
+SRC = os.path.dirname(os.path.abspath(__file__))
+RESULTS = os.path.join(os.path.dirname(SRC), 'benchmarks', 'results.jsonl')
+
+SCALES = [1_000, 10_000, 100_000]
+MOSAIC_SCALES = [10, 100]
+
+
+@contextmanager
+def workspace():
+    """
+    Run in a temporary directory: the pipeline reads and writes data/
+    relative to the working directory.
+    """
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as directory:
+        os.chdir(directory)
+        try:
+            yield directory
+        finally:
+            os.chdir(cwd)
+
+
+def quiet(func, *args, **kwargs):
+    with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+        return func(*args, **kwargs)
+
+
+def benchmark_process_dhs(n, seed=0):
+    import process_dhs
+
+    with workspace():
+        surveys = synthetic.write_surveys('data', n, seed=seed)
+        start = time.perf_counter()
+        for folder_path, country, year in surveys:
+            quiet(process_dhs.main, folder_path, country, year, 5)
+        return time.perf_counter() - start
+
+
+def benchmark_add_iwi(n, seed=0, households=5):
+    households = synthetic.households(n * households, seed)
+    with workspace():
+        return timed(add_iwi, households)[1]
+
+
+def benchmark_get_all_aoi(n, seed=0):
+    with workspace():
+        synthetic.write_label_sources('data', n, seed)
+        return timed(quiet, get_all_aoi, 5)[1]
+
+
+def synthetic_mosaic_tasks(n, seed=0):
+    lats, lons = synthetic.cluster_locations(n, seed)
+    return pd.DataFrame({'country': 'angola', 'year': 2010, 'month': 6, 'cluster_id': np.arange(n),
+                         'urban_rural': 'U', 'lat': lats, 'lon': lons,
+                         'area_of_interest': areas_of_interest(lats, lons, 5).tolist()})
+
+
+@contextmanager
+def local_stac(directory, seed=0):
+    dates = [datetime(2010, month, 15) for month in (2, 5, 8, 11)]
+    items = synthetic.write_scenes(os.path.join(directory, 'scenes'), dates, seed=seed)
+    with synthetic.LocalStac(items) as stac:
+        yield stac.url
+
+
+def benchmark_cloudless_mosaic(n, seed=0):
+    from src import test_mosaic
+
+    with workspace() as directory, local_stac(directory, seed) as url:
+        stac = test_mosaic.StacClient(url, modifier=None)
+        tasks = synthetic_mosaic_tasks(n, seed)
+        os.makedirs('tiles')
+        start = time.perf_counter()
+        for cluster_id, bbox in zip(tasks['cluster_id'], tasks['area_of_interest']):
+            quiet(test_mosaic.cloudless_mosaic, cluster_id, tuple(bbox), 2010, 6, 'tiles', stac=stac)
+        return time.perf_counter() - start
+
+
+def run_download_mpc(n, seed=0, **overrides):
+    """
+    download_mpc.main on n synthetic clusters served by a local STAC API,
+    with config values overridden by keyword. Returns the seconds it took.
+    """
+    from omegaconf import OmegaConf
+    from src import download_mpc
+
+    with workspace() as directory, local_stac(directory, seed) as url:
+        store.write_table(synthetic_mosaic_tasks(n, seed), 'data/areas_of_interest_month',
+                          partition_cols=['country', 'year'])
+        cfg = OmegaConf.load(os.path.join(SRC, 'config.yaml'))
+        cfg.stac_url = url
+        cfg.read_cache = os.path.join(directory, 'read_cache')
+        cfg.read_cache_gb = 1
+        for key, value in overrides.items():
+            cfg[key] = value
+        start = time.perf_counter()
+        # the function under the hydra decorator
+        quiet(download_mpc.main.__wrapped__, cfg)
+        return time.perf_counter() - start
+
+
+def benchmark_download_mpc(n, seed=0):
+    return run_download_mpc(n, seed)
+
+
+def benchmark_pipeline(n, seed=0):
+    return run_download_mpc(n, seed, pipeline=True)
+
+
+def benchmark_scheduler_pipeline(n=20, seed=0):
+    scheduled_time = run_download_mpc(n, seed)
+    print(f'scheduler.run_mosaics: {n} clusters in {scheduled_time:.2f}s')
+
+    pipelined_time = run_download_mpc(n, seed, pipeline=True)
+    print(f'pipeline.run_pipeline: {n} clusters in {pipelined_time:.2f}s')
+
+    return {'n': n, 'scheduled': scheduled_time, 'pipelined': pipelined_time}
+
+
+def benchmark_chip_loader(n=2_000, batch_size=64, seed=0):
+    from src import chip_store
+
+    with workspace():
+        dataset_csv = synthetic.write_tiles('data', n, catalog_path='data/tile_catalog.csv', seed=seed)
+        paths = [os.path.join('data', 'angola', '2010', f'{cluster}.tif') for cluster in range(n)]
+
+        start = time.perf_counter()
+        for path in paths:
+            chip_store.read_tile(path, 205)
+        rasterio_time = time.perf_counter() - start
+        print(f'read_tile: {n} tiles in {rasterio_time:.2f}s')
+
+        pack_time = timed(quiet, chip_store.pack, dataset_csv, 'data', 'chips', 'iwi', 'data/tile_catalog.csv')[1]
+        print(f'pack: {n} tiles in {pack_time:.2f}s')
+
+        store = chip_store.ChipStore('chips', 'train')
+        start = time.perf_counter()
+        for x, y in chip_store.BatchLoader(store, batch_size):
+            x.sum()
+        loader_time = time.perf_counter() - start
+        print(f'BatchLoader: {n} tiles in {loader_time:.4f}s')
+
+        print(f'speedup: {rasterio_time / loader_time:.1f}x')
+
+        return {'n': n, 'rasterio': rasterio_time, 'pack': pack_time, 'loader': loader_time}
+
+
+def benchmark_splits(n=200_000, seed=0):
+    from src import splits
+
+    with workspace():
+        lats, lons = synthetic.cluster_locations(n, seed, spread=20)
+        rng = np.random.default_rng(seed)
+        pd.DataFrame({'country': rng.choice(['angola', 'benin', 'chad'], n), 'year': 2010, 'cluster': np.arange(n),
+                      'lat': lats, 'lon': lons, 'iwi': rng.beta(2, 5, n) * 100}).to_csv('dataset.csv', index=False,
+                                                                                          sep=';')
+
+        split_time = timed(quiet, splits.train_test_split, 'dataset.csv', 'a', 0.8)[1]
+        print(f'train_test_split: {n} clusters in {split_time:.2f}s')
+
+    return {'n': n, 'split': split_time}
+
+
+BENCHMARKS = {'process_dhs.main': (benchmark_process_dhs, SCALES),
+              'compute_IWI.add_iwi': (benchmark_add_iwi, SCALES),
+              'process_IWI.get_all_aoi': (benchmark_get_all_aoi, SCALES),
+              'test_mosaic.cloudless_mosaic': (benchmark_cloudless_mosaic, MOSAIC_SCALES),
+              'download_mpc.main': (benchmark_download_mpc, MOSAIC_SCALES),
+              'pipeline.run_pipeline': (benchmark_pipeline, MOSAIC_SCALES)}
+
+
+def git_commit():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=SRC, capture_output=True, text=True,
+                                check=True).stdout.strip()
+        dirty = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=SRC,
+                               capture_output=True, text=True).stdout.strip()
+        return commit + ('-dirty' if dirty else '')
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def run_benchmarks(names=None, scales=None, mosaic_scales=None, results=RESULTS, seed=0):
+    """
+    Run the benchmarks `names` (all by default) at their scales, number
+    of clusters, and append the timings to the results file.
+    """
+    commit = git_commit()
+    if os.path.dirname(results):
+        os.makedirs(os.path.dirname(results), exist_ok=True)
+
+    rows = []
+    for name, (benchmark, default_scales) in BENCHMARKS.items():
+        if names and name not in names:
+            continue
+        if default_scales is MOSAIC_SCALES:
+            run_scales = mosaic_scales or default_scales
+        else:
+            run_scales = scales or default_scales
+
+        for n in run_scales:
+            seconds = benchmark(n, seed)
+            row = {'commit': commit, 'date': datetime.now().isoformat(timespec='seconds'), 'benchmark': name,
+                   'clusters': n, 'seconds': round(seconds, 4)}
+            print(f'{name}: {n} clusters in {seconds:.2f}s')
+            with open(results, 'a') as f:
+                f.write(json.dumps(row) + '\n')
+            rows.append(row)
+
+    return pd.DataFrame(rows)
+
+
+def compare(base, head, results=RESULTS):
+    """
+    Timings of two commits side by side, with the head / base ratio.
+    Several runs of a commit are averaged.
+    """
+    df = pd.read_json(results, lines=True, dtype={'commit': str})
+    timings = df.groupby(['benchmark', 'clusters', 'commit'])['seconds'].mean().unstack('commit')
+    comparison = timings[[base, head]].copy()
+    comparison['ratio'] = comparison[head] / comparison[base]
+    return comparison.round(3)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--only', nargs='*', choices=list(BENCHMARKS), help='pipeline benchmarks to run')
+    parser.add_argument('--scales', nargs='*', type=int, help=f'clusters of the table benchmarks, {SCALES}')
+    parser.add_argument('--mosaic-scales', nargs='*', type=int, help=f'clusters of the mosaic benchmarks, {MOSAIC_SCALES}')
+    parser.add_argument('--results', default=RESULTS, help='JSON lines file the timings are appended to')
+    parser.add_argument('--compare', nargs=2, metavar=('BASE', 'HEAD'), help='compare the results of two commits')
+    parser.add_argument('--reference', action='store_true',
+                        help='time the vectorized steps against the row-wise ones, the pipeline against the scheduler')
+    args = parser.parse_args()
+
+    if args.compare:
+        print(compare(*args.compare, results=args.results))
+    elif args.reference:
+        benchmark_iwi()
+        benchmark_cluster_ids()
+        benchmark_scheduler_pipeline()
+        benchmark_chip_loader()
+        benchmark_splits()
+    else:
+        run_benchmarks(args.only, args.scales, args.mosaic_scales, args.results)
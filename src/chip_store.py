@@ -0,0 +1,208 @@
+import os
+import mmap
+import json
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+import rasterio
+
+from src import tile_catalog
+
+
+# Training copy of the cluster tiles: the tiles of a split (train.csv,
+# test.csv...) packed into one fixed shape (cluster, band, y, x) .npy
+# file with the labels and an index table, so training reads memory
+# mapped arrays instead of opening thousands of small GeoTIFFs.
+#
+# <output_path>/<split>_x.npy    tiles, NaN where there is no data
+# <output_path>/<split>_y.npy    labels
+# <output_path>/<split>.csv      ';' separated index, row n of the arrays
+# <output_path>/<split>.json     shape, dtype and label of the split
+
+
+def read_tile(file_path, size, dtype='float32'):
+    """
+    Values of a tile (band scales and offsets applied, NaN for nodata),
+    center cropped, or padded with NaN, to size x size.
+    """
+    with rasterio.open(file_path) as src:
+        data = src.read(masked=True).astype(dtype)
+        scales = np.array(src.scales, dtype=dtype)[:, None, None]
+        offsets = np.array(src.offsets, dtype=dtype)[:, None, None]
+    data = (data * scales + offsets).filled(np.nan)
+
+    bands, height, width = data.shape
+    tile = np.full((bands, size, size), np.nan, dtype=dtype)
+    top, left = max(height - size, 0) // 2, max(width - size, 0) // 2
+    crop = data[:, top:top + size, left:left + size]
+    tile[:, :crop.shape[1], :crop.shape[2]] = crop
+    return tile
+
+
+def pack(dataset_csv, data_path, output_path, label='iwi', catalog_path='data/tile_catalog.csv', size=None,
+         bands=None, dtype='float32', seed=0, workers=8):
+    """
+    Pack the tiles data_path/<country>/<year>/<cluster>.tif of the rows of
+    dataset_csv (e.g. a split written by dataset_random_split) and their
+    label column into the chip store of the split, named after the csv.
+
+    size: side of the packed tiles, the smallest tile's by default.
+    bands: band count of the packed tiles, the most common one by default.
+    Tiles missing from the catalog (see `python -m src.tile_catalog` for
+    the ones written before it) or with another band count are left out,
+    ValueError if none is left.
+    Rows are shuffled with seed, so contiguous batches of the store are
+    random samples.
+
+    Returns the index table.
+    """
+    split = os.path.splitext(os.path.basename(dataset_csv))[0]
+    df = pd.read_csv(dataset_csv, sep=';')
+    cluster = 'cluster' if 'cluster' in df.columns else 'cluster_id'
+
+    # tile shapes from the catalog instead of opening every tile
+    tiles = tile_catalog.TileCatalog(catalog_path).table()[['country', 'year', 'cluster_id', 'path', 'bands',
+                                                            'height', 'width']]
+    tiles = tiles.rename(columns={'cluster_id': cluster})
+    df = df.merge(tiles, on=['country', 'year', cluster], how='inner')
+    df['path'] = [os.path.join(data_path, str(country), str(year), f'{cluster_id}.tif')
+                  for country, year, cluster_id in zip(df['country'], df['year'], df[cluster])]
+    df = df[[os.path.exists(file_path) for file_path in df['path']]]
+    if len(df) == 0:
+        raise ValueError(f'No tile of {dataset_csv} in {data_path} and {catalog_path}')
+
+    if bands is None:
+        bands = int(df['bands'].mode()[0])
+    skipped = (df['bands'] != bands).sum()
+    df = df[df['bands'] == bands]
+    if len(df) == 0:
+        raise ValueError(f'No tile of {dataset_csv} has {bands} bands')
+    if size is None:
+        size = int(min(df['height'].min(), df['width'].min()))
+
+    df = df.sample(frac=1, random_state=seed).reset_index(drop=True)
+    print(f'Packing {len(df)} tiles of {split} ({skipped} without {bands} bands) as {bands}x{size}x{size}')
+
+    os.makedirs(output_path, exist_ok=True)
+    x = np.lib.format.open_memmap(os.path.join(output_path, f'{split}_x.npy'), mode='w+', dtype=dtype,
+                                  shape=(len(df), bands, size, size))
+
+    def write(n, file_path):
+        x[n] = read_tile(file_path, size, dtype)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for future in [executor.submit(write, n, file_path) for n, file_path in enumerate(df['path'])]:
+            future.result()
+    x.flush()
+    del x
+
+    np.save(os.path.join(output_path, f'{split}_y.npy'), df[label].to_numpy(dtype=dtype))
+    index = df.drop(columns=['bands', 'height', 'width'])
+    index.to_csv(os.path.join(output_path, f'{split}.csv'), index=False, sep=';')
+    with open(os.path.join(output_path, f'{split}.json'), 'w') as f:
+        json.dump({'tiles': len(df), 'bands': bands, 'size': size, 'dtype': str(np.dtype(dtype)), 'label': label,
+                   'seed': seed}, f)
+
+    return index
+
+
+def map_npy(path):
+    """
+    Read-only, zero-copy array over a memory mapped .npy file, and the
+    mmap (for madvise).
+    """
+    with open(path, 'rb') as f:
+        version = np.lib.format.read_magic(f)
+        if version == (1, 0):
+            shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+        else:
+            shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+        offset = f.tell()
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    count = int(np.prod(shape))
+    array = np.frombuffer(mapped, dtype=dtype, count=count, offset=offset)
+    return array.reshape(shape, order='F' if fortran_order else 'C'), mapped, offset
+
+
+class ChipStore:
+    """
+    Packed split of output_path (see pack): x and y memory mapped, index
+    the table of the rows.
+    """
+
+    def __init__(self, output_path, split):
+        self.x, self.mapped, self.offset = map_npy(os.path.join(output_path, f'{split}_x.npy'))
+        self.y = np.load(os.path.join(output_path, f'{split}_y.npy'), mmap_mode='r')
+        self.index = pd.read_csv(os.path.join(output_path, f'{split}.csv'), sep=';')
+
+    def __len__(self):
+        return len(self.y)
+
+    def prefetch(self, start, stop):
+        """
+        Ask the kernel to read rows start:stop ahead, where madvise exists.
+        """
+        if not hasattr(self.mapped, 'madvise'):
+            return
+        row_bytes = self.x[0].nbytes if len(self) else 0
+        begin = self.offset + start * row_bytes
+        page_begin = begin - begin % mmap.PAGESIZE
+        self.mapped.madvise(mmap.MADV_WILLNEED, page_begin, self.offset + stop * row_bytes - page_begin)
+
+
+class BatchLoader:
+    """
+    Iterates over (x, y) minibatches of a ChipStore, with up to prefetch
+    batches read ahead by `workers` threads.
+
+    shuffle: 'batches' serves contiguous batches, views of the memory
+    map without a copy, in a new random order every epoch (the rows were
+    shuffled by pack). The rows of a batch are the same every epoch though,
+    only 'rows' (or packing again with another seed) changes them: it
+    draws every batch from all rows, at the cost of a copy. None keeps the
+    store order.
+    """
+
+    def __init__(self, store, batch_size=64, shuffle='batches', seed=0, workers=4, prefetch=8, drop_last=False):
+        if shuffle not in ('batches', 'rows', None):
+            raise ValueError(f'Unsupported shuffle: {shuffle}')
+        self.store = store
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.rng = np.random.default_rng(seed)
+        self.workers = workers
+        self.prefetch = prefetch
+        self.drop_last = drop_last
+
+    def __len__(self):
+        if self.drop_last:
+            return len(self.store) // self.batch_size
+        return -(-len(self.store) // self.batch_size)
+
+    def batches(self):
+        starts = np.arange(len(self)) * self.batch_size
+        if self.shuffle == 'rows':
+            order = self.rng.permutation(len(self.store))
+            # sorted within a batch so the gather walks the file forward
+            return [np.sort(order[start:start + self.batch_size]) for start in starts]
+        if self.shuffle == 'batches':
+            starts = self.rng.permutation(starts)
+        return [slice(start, min(start + self.batch_size, len(self.store))) for start in starts]
+
+    def load(self, batch):
+        if isinstance(batch, slice):
+            self.store.prefetch(batch.start, batch.stop)
+        return self.store.x[batch], self.store.y[batch]
+
+    def __iter__(self):
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            pending = deque()
+            for batch in self.batches():
+                pending.append(executor.submit(self.load, batch))
+                if len(pending) >= self.prefetch:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
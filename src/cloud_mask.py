@@ -0,0 +1,53 @@
+import numpy as np
+
+
+# Pixel-level masking with the Landsat Collection 2 QA_PIXEL band.
+# https://www.usgs.gov/landsat-missions/landsat-collection-2-quality-assessment-bands
+
+QA_BAND = 'qa_pixel'
+
+QA_FILL = 1 << 0
+QA_DILATED_CLOUD = 1 << 1
+QA_CIRRUS = 1 << 2
+QA_CLOUD = 1 << 3
+QA_CLOUD_SHADOW = 1 << 4
+QA_SNOW = 1 << 5
+
+# bits that make a pixel unusable for the composite
+QA_MASK = QA_FILL | QA_DILATED_CLOUD | QA_CIRRUS | QA_CLOUD | QA_CLOUD_SHADOW
+
+
+def clear_mask(qa, bits=QA_MASK):
+    """
+    True where none of the QA bits are set. Missing QA values (NaN fill
+    of the stack) count as fill.
+    """
+    return (qa.fillna(QA_FILL).astype('uint16') & bits) == 0
+
+
+def mask_clouds(data, bits=QA_MASK):
+    """
+    Lazily set to NaN every band of the (time, band, y, x) stack where the
+    QA band of the same scene flags the pixel.
+    """
+    if QA_BAND not in data['band'].values:
+        return data
+
+    return data.where(clear_mask(data.sel(band=QA_BAND), bits))
+
+
+def scenes_for_coverage(qa, coverage=0.95, min_clear=1, bits=QA_MASK, batch=4):
+    """
+    Number of leading scenes of a (time, y, x) QA stack needed so that a
+    `coverage` fraction of the pixels has at least `min_clear` clear
+    observations. QA is read `batch` scenes at a time and reading stops as
+    soon as the target is reached. Returns all the scenes if it never is.
+    """
+    counts = np.zeros(qa.shape[1:], dtype=int)
+
+    for start in range(0, qa.shape[0], batch):
+        counts += clear_mask(qa[start:start + batch], bits).sum(dim='time').values.astype(int)
+        if (counts >= min_clear).mean() >= coverage:
+            return min(start + batch, qa.shape[0])
+
+    return qa.shape[0]
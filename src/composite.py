@@ -0,0 +1,54 @@
+import warnings
+
+import numpy as np
+
+
+# Median compositing of a (time, band, y, x) stack, one spatial tile at a
+# time so only a tile of the stack is ever loaded in memory.
+
+
+def tile_size(shape, max_bytes, time_batch=None, itemsize=8):
+    """
+    Side in pixels of the largest square tile of a (time, band, y, x)
+    stack that fits in max_bytes, reading time_batch scenes at a time
+    if given.
+    """
+    time, band, height, width = shape
+    depth = min(time, time_batch) if time_batch else time
+    side = int(np.sqrt(max_bytes / (depth * band * itemsize)))
+    return max(1, min(side, max(height, width)))
+
+
+def nanmedian(block, time_batch=None):
+    """
+    Median over the time axis of a lazy block, ignoring NaNs. With
+    time_batch, the median of the medians of consecutive batches of
+    scenes: an approximation that only loads one batch at a time, for
+    very deep stacks.
+    """
+    with warnings.catch_warnings():
+        # all-NaN pixels are expected outside the scenes footprints
+        warnings.simplefilter('ignore', RuntimeWarning)
+        if not time_batch or block.shape[0] <= time_batch:
+            return np.nanmedian(block.values, axis=0)
+
+        medians = [np.nanmedian(block[start:start + time_batch].values, axis=0)
+                   for start in range(0, block.shape[0], time_batch)]
+        return np.nanmedian(np.stack(medians), axis=0)
+
+
+def tiled_median(data, tile, time_batch=None):
+    """
+    Same result as data.median(dim='time').compute() with tile x tile
+    spatial blocks computed one after the other. data should be chunked
+    by tile in y and x so each block only reads its own window.
+    """
+    template = data.median(dim='time')
+    band, height, width = template.shape
+    median = np.full((band, height, width), np.nan, dtype=template.dtype)
+
+    for y in range(0, height, tile):
+        for x in range(0, width, tile):
+            median[:, y:y + tile, x:x + tile] = nanmedian(data[:, :, y:y + tile, x:x + tile], time_batch)
+
+    return template.copy(data=median)
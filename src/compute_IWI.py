@@ -1,3 +1,5 @@
+import numpy as np
+
 constant = 25.00447
 toilet_quality = {'low': [23, 42, 43, 96, 31], 'medium': [20, 21, 22, 41, 51], 'high': [11, 12, 13, 14, 15, 16]}
 water_quality = {'low': [30, 32, 40, 42, 43, 96], 'medium': [13, 21, 31, 41, 51, 61, 62, 65, 72, 73],
@@ -17,6 +19,24 @@ asset_weights = {'television': 8.612657,
                  'sleeping_rooms': {'one': -3.699681, 'two': 0.38405, 'three': 3.445009}}
 
 
+IWI_COLUMNS = ['television', 'refrigerator', 'telephone', 'bicycle', 'car', 'cheap_utensils', 'expensive_utensils',
+               'electricity', 'water_quality', 'toilet_quality', 'floor_quality', 'sleeping_rooms', 'IWI']
+EXPENSIVE_ASSETS = ['car', 'motorboat', 'computer', 'motorcycle']
+CHEAP_ASSETS = ['expensive_utensils', 'television', 'refrigerator', 'telephone', 'radio', 'bicycle', 'watch',
+                'mobile_phone']
+
+# Categorical weights as arrays indexed by category code
+QUALITY_LEVELS = np.array(['low', 'medium', 'high', 'missing'])
+ROOM_LEVELS = np.array(['one', 'two', 'three'])
+ASSET_WEIGHTS_VECTOR = {asset: asset_weights[asset] for asset in ['television', 'refrigerator', 'telephone', 'car',
+                                                                  'bicycle', 'cheap_utensils', 'expensive_utensils',
+                                                                  'electricity']}
+WATER_WEIGHTS = np.array([asset_weights['water_quality'][level] for level in QUALITY_LEVELS])
+FLOOR_WEIGHTS = np.array([asset_weights['floor_quality'][level] for level in QUALITY_LEVELS])
+TOILET_WEIGHTS = np.array([asset_weights['toilet_quality'][level] for level in QUALITY_LEVELS])
+ROOM_WEIGHTS = np.array([asset_weights['sleeping_rooms'][level] for level in ROOM_LEVELS])
+
+
 def recode_sleeping_rooms(dataframe):
     dataframe['sleeping_rooms'] = dataframe['sleeping_rooms'].apply(
         lambda x: 'one' if x <= 1 else ('two' if x == 2 else 'three')
@@ -65,7 +85,7 @@ def add_cheap_utensils(dataframe):
     return dataframe
 
 
-def add_iwi(dataframe):
+def score_iwi_rowwise(dataframe):
     recode_toilet_quality(dataframe)
     recode_water_quality(dataframe)
     recode_sleeping_rooms(dataframe)
@@ -92,8 +112,47 @@ def add_iwi(dataframe):
         axis=1
     )
 
-    dataframe = dataframe[['television', 'refrigerator', 'telephone', 'bicycle', 'car', 'cheap_utensils',
-                           'expensive_utensils', 'electricity', 'water_quality', 'toilet_quality', 'floor_quality',
-                           'sleeping_rooms', 'IWI']]
+    return dataframe[IWI_COLUMNS]
+
+
+def quality_codes(values, quality):
+    # index into QUALITY_LEVELS, 3 ('missing') for unknown codes
+    return np.select([values.isin(quality['low']), values.isin(quality['medium']), values.isin(quality['high'])],
+                     [0, 1, 2], default=3)
+
+
+def score_iwi(dataframe):
+    # Same recodes and score as score_iwi_rowwise, computed column by column
+    toilet = quality_codes(dataframe['toilet_quality'], toilet_quality)
+    water = quality_codes(dataframe['water_quality'], water_quality)
+    rooms = np.select([dataframe['sleeping_rooms'] <= 1, dataframe['sleeping_rooms'] == 2], [0, 1], default=2)
+    # recode_floor_quality maps every household to 'medium'
+    floor = np.full(len(dataframe), 1)
+
+    dataframe['toilet_quality'] = QUALITY_LEVELS[toilet]
+    dataframe['water_quality'] = QUALITY_LEVELS[water]
+    dataframe['sleeping_rooms'] = ROOM_LEVELS[rooms]
+    dataframe['floor_quality'] = QUALITY_LEVELS[floor]
+
+    dataframe['expensive_utensils'] = (dataframe[EXPENSIVE_ASSETS] == 1).any(axis=1).astype(int)
+    dataframe['cheap_utensils'] = ((dataframe[CHEAP_ASSETS] == 1).any(axis=1)
+                                   | (floor == 2) | (toilet == 2)).astype(int)
+
+    assets = dataframe[list(ASSET_WEIGHTS_VECTOR)].to_numpy(dtype=float)
+    dataframe['IWI'] = (constant
+                        + assets @ np.array(list(ASSET_WEIGHTS_VECTOR.values()))
+                        + WATER_WEIGHTS[water]
+                        + FLOOR_WEIGHTS[floor]
+                        + TOILET_WEIGHTS[toilet]
+                        + ROOM_WEIGHTS[rooms])
+
+    return dataframe[IWI_COLUMNS]
+
+
+def add_iwi(dataframe, vectorized=True):
+    if vectorized:
+        dataframe = score_iwi(dataframe)
+    else:
+        dataframe = score_iwi_rowwise(dataframe)
 
     dataframe.to_csv('data.csv')
@@ -0,0 +1,58 @@
+import numpy as np
+import pandas as pd
+import pyreadstat
+
+
+# Readers for the DHS recode files that only load the columns the
+# pipeline uses, so large household recodes with thousands of columns
+# don't have to fit in memory.
+
+SURVEY_COLUMNS = ['hv006', 'hv007', 'hhid', 'hv001', 'hv025']
+IWI_COLUMNS = ['HHID', 'iwi']
+
+
+def compact_dtypes(df):
+    """
+    Downcast numeric columns holding only whole numbers (pyreadstat may
+    read them as float64 or int64) to the smallest integer dtype. Columns
+    with missing or fractional values are left as they are.
+    """
+    for column in df.columns:
+        values = df[column]
+        whole = values.dtype.kind == 'i' or (values.dtype.kind == 'f' and values.notna().all()
+                                             and np.array_equal(values, values.round()))
+        if whole and len(values):
+            df[column] = pd.to_numeric(values, downcast='integer')
+    return df
+
+
+def read_columns(read_function, path, columns, processes=1, chunksize=None):
+    """
+    Read only `columns` of a file with a pyreadstat read function
+    (read_dta, read_sav...), with `processes` worker processes and, if
+    chunksize is given, chunksize rows at a time.
+    """
+    if chunksize:
+        chunks = pyreadstat.read_file_in_chunks(read_function, path, chunksize=chunksize, usecols=columns,
+                                                multiprocess=processes > 1, num_processes=processes)
+        df = pd.concat([compact_dtypes(chunk) for chunk, meta in chunks], ignore_index=True)
+    elif processes > 1:
+        df, meta = pyreadstat.read_file_multiprocessing(read_function, path, num_processes=processes, usecols=columns)
+    else:
+        df, meta = read_function(path, usecols=columns)
+
+    return compact_dtypes(df)
+
+
+def read_survey(path, columns=SURVEY_COLUMNS, processes=1, chunksize=None):
+    """
+    Household recode (.DTA) columns used by process_dhs.main.
+    """
+    return read_columns(pyreadstat.read_dta, path, columns, processes, chunksize)
+
+
+def read_iwi(path, columns=IWI_COLUMNS, processes=1, chunksize=None):
+    """
+    Household IWI (.sav) columns used by process_IWI.get_IWI_global.
+    """
+    return read_columns(pyreadstat.read_sav, path, columns, processes, chunksize)
@@ -1,10 +1,8 @@
 import pandas as pd
-import rasterio
-from tqdm import tqdm
 
 import os
 
-import test_mosaic
+from src import scheduler, pipeline, store, cloud_mask, tile_catalog, profiling, splits, test_mosaic
 
 import logging
 import hydra
@@ -17,98 +15,92 @@ log = logging.getLogger(__name__)
 
 @hydra.main(version_base=None, config_path="", config_name="config")
 def main(cfg: DictConfig):
-    csv = pd.read_csv('data/areas_of_interest_month.csv', sep=';')
-
-    df = convert_bbox_to_tuple(csv)
-    error_log = []
-    df_items = []
-
-    for country in df['country'].unique():
-        df_country = df[df['country'] == country]
-        print('country:', country)
-        for year in df_country['year'].unique():
-            df_items_year = []
-            df_year = df_country[df_country['year'] == year]
-            output_path = os.path.join(os.getcwd(), "data", country, str(year))
-            print('year:', year)
-            if not os.path.exists(output_path):
-                print(f'creating {output_path}')
-                os.makedirs(output_path)
-
-            for cluster in df_year['cluster_id'].unique():
-
-                if not os.path.exists(os.path.join(output_path, f'{cluster}.tif')):
-
-                    bbox = df_year[df_year['cluster_id'] == cluster]['area_of_interest'].values[0]
-                    month = df_year[df_year['cluster_id'] == cluster]['month'].values[0]
-                    print('cluster:', cluster, 'bbox:', bbox)
-
-                    try:
-                        items = test_mosaic.cloudless_mosaic(cluster, bbox, year, month, output_path, cfg.cloud_cover,
-                                                             cfg.time_span, cfg.epsg)
-                        df_items_year.append({'country': country, 'year': year, 'cluster_id': cluster, "items": len(items)})
-                        df_items.append(df_items_year)
-                        log.info(f'Processed {country}/{year}/{cluster} with items \n {items[:]}')
-                    except Exception as e:
-                        print(e)
-                        log.error(f'Error processing {country}/{year}/{cluster}: {e}')
+    df = store.read_table('data/areas_of_interest_month')
+
+    ledger = scheduler.JobLedger(cfg.ledger)
+    catalog = tile_catalog.TileCatalog(cfg.tile_catalog)
+    tasks = scheduler.plan_tasks(df, os.path.join(os.getcwd(), 'data'), ledger, cfg.max_attempts)
+
+    options = dict(search_concurrency=cfg.search_concurrency,
+                   compute_concurrency=cfg.compute_concurrency,
+                   max_attempts=cfg.max_attempts,
+                   batch_search=cfg.batch_search,
+                   cell_size=cfg.search_cell_size,
+                   cache_dir=cfg.read_cache,
+                   cache_bytes=int(cfg.read_cache_gb * 1024 ** 3),
+                   stac=test_mosaic.StacClient(cfg.stac_url, pool_size=max(cfg.search_concurrency, 10)),
+                   catalog=catalog,
+                   profiler=profiling.Profiler(cfg.profile),
+                   median_memory=int(cfg.median_memory_mb * 1024 ** 2) if cfg.median_memory_mb else None,
+                   time_batch=cfg.median_time_batch,
+                   qa_bits=cloud_mask.QA_MASK if cfg.qa_mask else None,
+                   clear_coverage=cfg.clear_coverage,
+                   min_clear=cfg.min_clear,
+                   assets=list(cfg.assets) if cfg.assets else None,
+                   dtype=cfg.dtype,
+                   output_dtype=cfg.output_dtype,
+                   cog=cfg.cog)
+
+    if cfg.pipeline and not cfg.chips:
+        counts = pipeline.run_pipeline(tasks, ledger, cfg.cloud_cover, cfg.time_span, cfg.epsg,
+                                       prefetch=cfg.prefetch,
+                                       write_queue=cfg.write_queue,
+                                       **options)
+    else:
+        counts = scheduler.run_mosaics(tasks, ledger, cfg.cloud_cover, cfg.time_span, cfg.epsg,
+                                       workers=cfg.workers,
+                                       chips=cfg.chips,
+                                       region_size=cfg.region_size,
+                                       region_dir=cfg.region_dir,
+                                       keep_regions=cfg.keep_regions,
+                                       **options)
+    log.info(f'Mosaic jobs: {counts}')
+
 
 def convert_bbox_to_tuple(df):
-    # Convert the area_of_interest column to tuple of floats
+    # Convert the area_of_interest column of a csv export to tuple of floats
     df['area_of_interest'] = df['area_of_interest'].apply(lambda x: tuple(map(float, x.strip('[]').split(','))))
 
     return df
 
 
-def extract_country_year_cluster(data_path, output_path):
-    data = []
-
-    for country_folder in os.listdir(data_path):
-        country_path = os.path.join(data_path, country_folder)
-        if os.path.isdir(country_path):
-            for year_folder in os.listdir(country_path):
-                year_path = os.path.join(country_path, year_folder)
-                if os.path.isdir(year_path):
-                    for cluster_file in os.listdir(year_path):
-                        if cluster_file.endswith('.tif'):
-                            cluster_id = int(cluster_file.split('.')[0])
-                            data.append({'country': country_folder, 'year': year_folder, 'cluster_id': cluster_id})
-
-    df = pd.DataFrame(data)
-    df.to_csv(output_path, index=False, sep=';')
-
+# Queries of the tile catalog, data_path/tile_catalog.csv by default.
+# Tiles written before the catalog existed are only in it once added with
+# `python -m src.tile_catalog`.
 
-def select_landsat7(dataset_csv, data_path, output_path):
-    data = []
 
-    dataframe = pd.read_csv(dataset_csv, sep=';')
+def open_catalog(data_path, catalog_path=None):
+    catalog_path = catalog_path or os.path.join(data_path, 'tile_catalog.csv')
+    if not os.path.exists(catalog_path):
+        raise FileNotFoundError(f'No tile catalog {catalog_path}, see python -m src.tile_catalog')
+    return tile_catalog.TileCatalog(catalog_path)
 
-    for idx in tqdm(range(len(dataframe))):
 
-        row = dataframe.iloc[idx]
+def extract_country_year_cluster(data_path, output_path, catalog_path=None):
+    df = open_catalog(data_path, catalog_path).table()[['country', 'year', 'cluster_id']]
+    df.to_csv(output_path, index=False, sep=';')
 
-        tile_name = os.path.join(data_path,
-                                 str(row.country),
-                                 str(row.year),
-                                 str(row.cluster) + ".tif"
-                                 )
 
-        with rasterio.open(tile_name) as src:
-            if len(src.indexes) == 19:
-                data.append(row)
+def select_landsat7(dataset_csv, data_path, output_path, catalog_path=None, bands=19):
+    # tiles composited from Landsat 7 scenes, from the catalog instead of opening every tile
+    tiles = open_catalog(data_path, catalog_path).table()
 
-    df = pd.DataFrame(data)
+    dataframe = pd.read_csv(dataset_csv, sep=';')
+    cluster = 'cluster' if 'cluster' in dataframe.columns else 'cluster_id'
+
+    # sensor is e.g. 'landsat-7+landsat-8', empty for backfilled tiles, told apart by the Landsat 7 band count
+    sensors = tiles['sensor'].fillna('')
+    landsat7 = [sensor == '' and band_count == bands or 'landsat-7' in sensor.split('+')
+                for sensor, band_count in zip(sensors, tiles['bands'])]
+    selected = tiles.loc[landsat7, ['country', 'year', 'cluster_id']].rename(columns={'cluster_id': cluster})
+    df = dataframe.merge(selected, on=['country', 'year', cluster], how='inner')
     df.to_csv(output_path, index=False, sep=';')
 
 
-def dataset_random_split(dataset_csv, output_path, train_ratio=0.8):
-    df = pd.read_csv(dataset_csv, sep=';')
-
-    train_df = df.sample(frac=train_ratio)
-    test_df = df.drop(train_df.index)
-
-    train_df.to_csv(output_path + '/train.csv', index=False, sep=';')
-    test_df.to_csv(output_path + '/test.csv', index=False, sep=';')
+def dataset_random_split(dataset_csv, output_path, train_ratio=0.8, seed=0, block_size=0.5, by_country=False):
+    # whole grid blocks of clusters per split, stratified on iwi and reproducible with seed (see splits)
+    return splits.train_test_split(dataset_csv, output_path, train_ratio, seed=seed, block_size=block_size,
+                                   by_country=by_country)
 
 
 if __name__ == "__main__":
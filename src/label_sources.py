@@ -0,0 +1,101 @@
+import os
+import glob
+import threading
+
+import numpy as np
+import pandas as pd
+
+from src.manifest import file_state
+
+
+# Label source csv files (Global Data Lab, Pettersson, SustainBench) read
+# and normalized once: the normalized frame is kept in memory and cached
+# as parquet next to the other data, keyed by the hash of the source file,
+# so a changed source is read again and an unchanged one never is.
+
+
+class LabelRegistry:
+    """
+    Named label sources, each a file and the function normalizing the
+    frame read from it. Frames are cached in process and in cache_dir
+    (None for the process only), invalidated when the file content or
+    the version of the source changes.
+    """
+
+    def __init__(self, cache_dir='data/label_cache'):
+        self.cache_dir = cache_dir
+        self.sources = {}
+        self.frames = {}
+        # path -> manifest.file_state, so unchanged files are not hashed again
+        self.states = {}
+        self.lock = threading.Lock()
+
+    def register(self, name, path, normalize, version=1, read=pd.read_csv):
+        """
+        Add the source name: normalize(read(path)). Bump version when
+        normalize changes, to invalidate the cached frames.
+        """
+        self.sources[name] = (path, normalize, version, read)
+        self.frames.pop(name, None)
+
+    def hash(self, path):
+        self.states[path] = file_state(path, self.states.get(path))
+        return self.states[path]['sha1']
+
+    def frame(self, name):
+        """
+        Normalized frame of the source, shared: use view to get a copy.
+        """
+        path, normalize, version, read = self.sources[name]
+        with self.lock:
+            key = f'{name}-v{version}-{self.hash(path)}'
+            if name not in self.frames or self.frames[name][0] != key:
+                self.frames[name] = (key, self.load(name, key, path, normalize, read))
+            return self.frames[name][1]
+
+    def load(self, name, key, path, normalize, read):
+        cache_path = os.path.join(self.cache_dir, f'{key}.parquet') if self.cache_dir else None
+        if cache_path and os.path.exists(cache_path):
+            return pd.read_parquet(cache_path)
+
+        df = normalize(read(path)).reset_index(drop=True)
+
+        if cache_path:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            for stale in glob.glob(os.path.join(self.cache_dir, f'{name}-v*.parquet')):
+                # another worker may have just written, and be reading, this key
+                if stale != cache_path:
+                    try:
+                        os.remove(stale)
+                    except FileNotFoundError:
+                        pass
+            # written aside and renamed, survey worker processes may load the same source
+            tmp_path = f'{cache_path}.{os.getpid()}.tmp'
+            df.to_parquet(tmp_path, index=False)
+            os.replace(tmp_path, cache_path)
+
+        return df
+
+    def view(self, name, country=None, year=None, bbox=None):
+        """
+        Copy of the rows of the source in country (case insensitive), year
+        and bbox (xmin, ymin, xmax, ymax in lon/lat), each if given.
+        """
+        df = self.frame(name)
+        mask = np.ones(len(df), dtype=bool)
+        if country is not None:
+            mask &= (df['country'].str.lower() == str(country).lower()).to_numpy()
+        if year is not None:
+            mask &= (df['year'] == int(year)).to_numpy()
+        if bbox is not None:
+            xmin, ymin, xmax, ymax = bbox
+            mask &= df['lon'].between(xmin, xmax).to_numpy() & df['lat'].between(ymin, ymax).to_numpy()
+        return df[mask].copy()
+
+    def warm(self, *names):
+        """
+        Load the sources whose file exists, e.g. before forking workers.
+        """
+        for name in names:
+            if os.path.exists(self.sources[name][0]):
+                self.frame(name)
@@ -0,0 +1,81 @@
+import os
+import json
+import hashlib
+
+
+# Record of the inputs (content hash, mtime, size) and parameters each
+# output was built from, so a pipeline stage can skip up to date work.
+
+
+def file_hash(path, block_size=1 << 20):
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+
+def file_state(path, previous=None):
+    """
+    mtime, size and sha1 of a file. The hash of `previous` is reused when
+    the mtime and size did not change, so unchanged files are not read.
+    """
+    stat = os.stat(path)
+    state = {'mtime': stat.st_mtime, 'size': stat.st_size}
+    if previous and previous.get('mtime') == state['mtime'] and previous.get('size') == state['size']:
+        state['sha1'] = previous['sha1']
+    else:
+        state['sha1'] = file_hash(path)
+    return state
+
+
+class Manifest:
+    """
+    JSON manifest mapping a key (e.g. 'angola/2006') to the state of its
+    input files, its parameters and the outputs it produced.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                self.entries = json.load(f)
+
+    def is_current(self, key, inputs, params=None):
+        """
+        True if key was recorded with the same parameters and inputs of the
+        same content, and its outputs still exist.
+        """
+        entry = self.entries.get(key)
+        if entry is None or entry['params'] != (params or {}):
+            return False
+        if sorted(entry['inputs']) != sorted(inputs):
+            return False
+        if not all(os.path.exists(output) for output in entry['outputs']):
+            return False
+
+        for path in inputs:
+            state = file_state(path, entry['inputs'][path])
+            if state['sha1'] != entry['inputs'][path]['sha1']:
+                return False
+            # a touched but identical file: keep the new mtime to skip hashing next time
+            entry['inputs'][path] = state
+
+        return True
+
+    def record(self, key, inputs, params=None, outputs=(), **extra):
+        previous = self.entries.get(key, {}).get('inputs', {})
+        self.entries[key] = {'inputs': {path: file_state(path, previous.get(path)) for path in inputs},
+                             'params': params or {},
+                             'outputs': list(outputs),
+                             **extra}
+
+    def save(self):
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        tmp_path = f'{self.path}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.entries, f, indent=1, sort_keys=True)
+        os.replace(tmp_path, self.path)
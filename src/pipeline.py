@@ -0,0 +1,224 @@
+import os
+import time
+import queue
+import asyncio
+import logging
+import threading
+
+from src import test_mosaic, search_planner, read_cache, profiling, scheduler, tile_catalog
+
+log = logging.getLogger(__name__)
+
+
+# Staged alternative to scheduler.run_mosaics: an asyncio stage searches
+# (and signs, through the StacClient modifier) the items of the upcoming
+# clusters, compute threads take them from a bounded queue to compute the
+# medians and a writer thread writes the GeoTIFFs. A full queue blocks the
+# stage feeding it, so searches never run further ahead of the compute
+# than the queue sizes allow.
+
+
+# end of a stage's input
+END = None
+
+
+class StageQueue(queue.Queue):
+    """
+    Bounded queue between two stages, recording its depth at every put
+    and the time producers spent blocked on a full queue (backpressure)
+    and consumers on an empty one (starvation).
+    """
+
+    def __init__(self, name, maxsize):
+        super().__init__(maxsize)
+        self.name = name
+        self.puts = 0
+        self.depth_sum = 0
+        self.max_depth = 0
+        self.put_wait = 0.0
+        self.get_wait = 0.0
+
+    def put(self, item, block=True, timeout=None):
+        start = time.perf_counter()
+        super().put(item, block, timeout)
+        with self.mutex:
+            depth = self._qsize()
+            self.put_wait += time.perf_counter() - start
+            self.puts += 1
+            self.depth_sum += depth
+            self.max_depth = max(self.max_depth, depth)
+
+    def get(self, block=True, timeout=None):
+        start = time.perf_counter()
+        item = super().get(block, timeout)
+        with self.mutex:
+            self.get_wait += time.perf_counter() - start
+        return item
+
+    def close(self, consumers=1):
+        """
+        Tell `consumers` consumers there is no more input, outside of the
+        metrics.
+        """
+        for _ in range(consumers):
+            super().put(END)
+
+    def summary(self):
+        with self.mutex:
+            return {'queue': self.name, 'maxsize': self.maxsize, 'puts': self.puts,
+                    'mean_depth': round(self.depth_sum / self.puts, 2) if self.puts else 0,
+                    'max_depth': self.max_depth, 'put_wait_seconds': round(self.put_wait, 3),
+                    'get_wait_seconds': round(self.get_wait, 3)}
+
+
+def run_pipeline(tasks, ledger, cloud_cover=25, time_span=2, epsg=3857, search_concurrency=4,
+                 compute_concurrency=2, max_attempts=3, stac=None, batch_search=True, cell_size=5.0,
+                 cache_dir=None, cache_bytes=50 * 1024 ** 3, catalog=None, profiler=None, prefetch=8,
+                 write_queue=2, output_dtype=None, cog=False, **mosaic_options):
+    """
+    Run the cluster mosaics as a search -> compute -> write pipeline.
+    Takes the same tasks, ledger and options as scheduler.run_mosaics,
+    which remains the way to run the chip mode.
+
+    prefetch: searched clusters waiting for a compute thread. Searches
+    pause when it is reached.
+    write_queue: computed medians waiting for the writer. Compute threads
+    pause when it is reached.
+    output_dtype, cog: file options (see test_mosaic.write_raster),
+    applied by the writer.
+    mosaic_options: compositing options passed on to
+    test_mosaic.compute_median (median_memory, qa_bits, clear_coverage...).
+
+    The queue metrics are logged, and written to the profile as 'queue'
+    records. Returns the ledger counts.
+    """
+    runnable = ledger.runnable(max_attempts)
+    tasks = [task for task in tasks
+             if ledger.key(task['country'], task['year'], task['cluster_id']) in runnable]
+
+    if stac is None:
+        stac = test_mosaic.StacClient(pool_size=max(search_concurrency, 10))
+
+    reader = read_cache.cached_reader(cache_dir, cache_bytes) if cache_dir else None
+
+    if profiler is None:
+        profiler = profiling.Profiler()
+    records = {ledger.key(task['country'], task['year'], task['cluster_id']):
+               profiler.record('cluster', country=task['country'], year=task['year'], cluster_id=task['cluster_id'])
+               for task in tasks}
+
+    def record_of(task):
+        return records[ledger.key(task['country'], task['year'], task['cluster_id'])]
+
+    searched = StageQueue('search', prefetch)
+    computed = StageQueue('write', write_queue)
+
+    def finish(task, items=None, error=None):
+        name = f"{task['country']}/{task['year']}/{task['cluster_id']}"
+        if error is None:
+            ledger.mark(task['country'], task['year'], task['cluster_id'], scheduler.DONE, items=len(items))
+            record_of(task).emit(status=scheduler.DONE, items=len(items))
+            log.info(f'Processed {name} with {len(items)} items')
+        else:
+            ledger.mark(task['country'], task['year'], task['cluster_id'], scheduler.FAILED, error=error)
+            record_of(task).emit(status=scheduler.FAILED, error=str(error))
+            log.error(f'Error processing {name}: {error}')
+
+    def search(group):
+        # blocking pystac_client calls, run in the event loop's executor
+        if batch_search:
+            record = profiler.record('search', country=group['tasks'][0]['country'],
+                                     year=group['tasks'][0]['year'])
+            with record.stage('search'):
+                assigned = search_planner.search_group(stac, group, cloud_cover)
+            record.emit(clusters=len(group['tasks']), items=len({item.id for items in assigned for item in items}))
+            return assigned
+
+        task = group['tasks'][0]
+        with record_of(task).stage('search'):
+            return [test_mosaic.search_items(stac, task['bbox'], task['year'], task['month'], cloud_cover,
+                                             time_span)]
+
+    async def produce(groups):
+        slots = asyncio.Semaphore(search_concurrency)
+
+        async def search_one(group):
+            # the slot is held until the results are queued, so a full queue stops new searches
+            async with slots:
+                try:
+                    assigned = await asyncio.to_thread(search, group)
+                except Exception as e:
+                    for task in group['tasks']:
+                        finish(task, error=e)
+                    return
+                for task, items in zip(group['tasks'], assigned):
+                    await asyncio.to_thread(searched.put, (task, items))
+
+        await asyncio.gather(*(search_one(group) for group in groups))
+
+    def search_stage(groups):
+        try:
+            asyncio.run(produce(groups))
+        finally:
+            searched.close(compute_concurrency)
+
+    def compute_stage():
+        while (job := searched.get()) is not END:
+            task, items = job
+            try:
+                with stac.metrics.timer('compute'):
+                    median, items = test_mosaic.compute_median(items, task['bbox'], epsg, reader,
+                                                               record=record_of(task), **mosaic_options)
+            except Exception as e:
+                finish(task, error=e)
+                continue
+            computed.put((task, median, items))
+
+    def write_stage():
+        while (job := computed.get()) is not END:
+            task, median, items = job
+            file_path = os.path.join(task['output_path'], f"{task['cluster_id']}.tif")
+            try:
+                with record_of(task).stage('write'):
+                    test_mosaic.write_raster(median, items, file_path, output_dtype, cog)
+                stac.metrics.count('mosaics')
+                stac.metrics.count('scenes', len(items))
+                if catalog is not None:
+                    catalog.add(task['country'], task['year'], task['cluster_id'],
+                                tile_catalog.describe(median, items, file_path, epsg, output_dtype))
+            except Exception as e:
+                finish(task, error=e)
+                continue
+            finish(task, items=items)
+
+    if batch_search:
+        groups = search_planner.plan_searches(tasks, time_span, cell_size)
+        log.info(f'Planned {len(groups)} searches for {len(tasks)} clusters')
+    else:
+        groups = [{'tasks': [task]} for task in tasks]
+
+    log.info(f'Pipelining {len(tasks)} clusters: {search_concurrency} searches, {compute_concurrency} computes, '
+             f'queues of {prefetch} and {write_queue}')
+
+    searcher = threading.Thread(target=search_stage, args=(groups,), name='search')
+    computers = [threading.Thread(target=compute_stage, name=f'compute-{n}') for n in range(compute_concurrency)]
+    writer = threading.Thread(target=write_stage, name='write')
+    for thread in [searcher, *computers, writer]:
+        thread.start()
+
+    searcher.join()
+    for thread in computers:
+        thread.join()
+    computed.close()
+    writer.join()
+
+    for stage_queue in [searched, computed]:
+        summary = stage_queue.summary()
+        log.info(f'Queue metrics: {summary}')
+        profiler.record('queue', stage=summary.pop('queue')).emit(**summary)
+
+    log.info(f'STAC metrics: {stac.metrics.summary()}')
+    if profiler.path:
+        log.info(f'Stage profile ({profiler.path}):\n{profiler.summary()}')
+
+    return ledger.counts()
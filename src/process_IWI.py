@@ -6,7 +6,12 @@ import matplotlib.pyplot as plt
 import scipy.stats
 import pyreadstat
 from sklearn.metrics import r2_score
-from src.utils import area_of_interest
+from src.utils import areas_of_interest
+from src.dhs_reader import read_iwi
+from src.store import AOI_COLUMNS, write_table
+from src.spatial_join import TOLERANCE_KM, spatial_join, spatial_drop_duplicates, search_bounds
+from src.label_sources import LabelRegistry
+from src.profiling import Profiler
 
 import os
 
@@ -32,8 +37,7 @@ def read_IWI(input_path, output_path):
     return output
 
 
-def read_global_data_lab():
-    df = pd.read_csv('data/global_data_lab_only.csv')
+def normalize_global_data_lab(df):
     df['urban_rural'] = df['urban_rural'].map({1: 'U', 2: 'R'})
 
     df['lat'] = df['lat'].round(6)
@@ -42,8 +46,8 @@ def read_global_data_lab():
     return df
 
 
-def read_sustain_bench():
-    df = pd.read_csv('data/dhs_final_labels.csv')[['cname', 'year', 'cluster_id', 'urban', 'lat', 'lon', 'asset_index']]
+def normalize_sustain_bench(df):
+    df = df[['cname', 'year', 'cluster_id', 'urban', 'lat', 'lon', 'asset_index']]
     df = df[df['cname'].isin(CNAMES.keys())].rename(columns={'cname': 'country'})
     df['country'] = df['country'].map(CNAMES)
     df.rename(columns={'asset_index': 'iwi'}, inplace=True)
@@ -58,9 +62,9 @@ def read_sustain_bench():
     return df
 
 
-def read_petterson():
-    df = pd.read_csv('data/dhs_clusters_rounded.csv')[['country', 'year', 'rural', 'lat', 'lon', 'iwi']]
-    df.rename(columns={'rural': 'urban_rural'}, inplace=True)
+def normalize_petterson(df):
+    df = df[['country', 'year', 'rural', 'lat', 'lon', 'iwi']]
+    df = df.rename(columns={'rural': 'urban_rural'})
     df['urban_rural'] = df['urban_rural'].map({0: 'U', 1: 'R'})
 
     df['month'] = 1
@@ -71,16 +75,45 @@ def read_petterson():
     return df
 
 
-def get_IWI_petterson(df):
+def normalize_dhs_clusters(df):
+    df = df[['lat', 'lon', 'iwi']].copy()
+
+    df['lat'] = df['lat'].round(6)
+    df['lon'] = df['lon'].round(6)
+
+    return df
+
+
+# each source is parsed and normalized once, then served from the cache (see label_sources)
+LABELS = LabelRegistry()
+# the table process_dhs.build_global_data_lab_only writes
+LABELS.register('global_data_lab', 'data/global_data_lab.parquet', normalize_global_data_lab, version=2,
+                read=pd.read_parquet)
+LABELS.register('sustain_bench', 'data/dhs_final_labels.csv', normalize_sustain_bench)
+LABELS.register('petterson', 'data/dhs_clusters_rounded.csv', normalize_petterson)
+LABELS.register('dhs_clusters', 'data/dhs_clusters.csv', normalize_dhs_clusters)
+
+
+def read_global_data_lab(country=None, year=None):
+    return LABELS.view('global_data_lab', country, year)
+
+
+def read_sustain_bench(country=None, year=None):
+    return LABELS.view('sustain_bench', country, year)
+
+
+def read_petterson(country=None, year=None):
+    return LABELS.view('petterson', country, year)
+
+
+def get_IWI_petterson(df, tolerance_km=TOLERANCE_KM):
     df.drop_duplicates('cluster_id', inplace=True)
     df.drop(columns=['HHID'], inplace=True)
-    df_iwi = pd.read_csv('data/dhs_clusters.csv', sep=',')
-    df_iwi = df_iwi[['lat', 'lon', 'iwi']]
 
-    df_iwi['lat'] = df_iwi['lat'].round(6)
-    df_iwi['lon'] = df_iwi['lon'].round(6)
+    # only the Pettersson clusters that can be within tolerance_km of the survey's
+    df_iwi = LABELS.view('dhs_clusters', bbox=search_bounds(df, tolerance_km))
 
-    output = pd.merge(df, df_iwi, on=['lat', 'lon'], how='inner')
+    output = spatial_join(df, df_iwi, tolerance_km).drop(columns='distance_km')
 
     return output
 
@@ -101,10 +134,10 @@ def calculate_mean_iwi_per_cluster(df):
 
 
 def get_IWI_global(df, input_path):
-    df_iwi = read_IWI(input_path, os.path.join(os.path.dirname(input_path), 'iwi.csv'))
+    # only the columns used here, without the csv copy of read_IWI
+    df_iwi = read_iwi(input_path)
 
-    df_iwi = df_iwi[['HHID', 'iwi']]
-    df_iwi['HHID'] = df_iwi['HHID'].str.strip()
+    df_iwi['HHID'] = df_iwi['HHID'].astype(str).str.strip()
 
     output = pd.merge(df, df_iwi, on='HHID', how='inner')
     output = calculate_mean_iwi_per_cluster(output)
@@ -112,16 +145,16 @@ def get_IWI_global(df, input_path):
     return output
 
 
-def compute_correlation_petterson(petterson_path, global_data_lab_path):
+def compute_correlation_petterson(petterson_path, global_data_lab_path, tolerance_km=TOLERANCE_KM):
     # Read the CSV files
     df_sustain_bench = pd.read_csv(petterson_path)
     df_sustain_bench.dropna(subset=['iwi'], inplace=True)
     df_global_data_lab = pd.read_csv(global_data_lab_path)
 
-    # Merge the DataFrames on common columns (e.g., lat and lon)
-    merged_df = pd.merge(df_sustain_bench, df_global_data_lab, on=['lat', 'lon'], suffixes=('_petterson', '_global'))
-    merged_df.drop(columns=['country_global', 'year_global', 'area_of_interest', 'urban_rural', 'lat', 'lon'],
-                   inplace=True)
+    # Match the clusters within tolerance_km of each other
+    merged_df = spatial_join(df_sustain_bench, df_global_data_lab, tolerance_km, suffixes=('_petterson', '_global'))
+    merged_df.drop(columns=['country_global', 'year_global', 'area_of_interest', 'urban_rural', 'lat', 'lon',
+                            'distance_km'], inplace=True)
 
     merged_df.to_csv('../data/merged_petterson.csv', index=False)
 
@@ -158,47 +191,75 @@ def normalize_iwi(file_path):
     df.to_csv('../data/global_data_lab_normalized.csv', index=False)
 
 
-def get_all_aoi(buffer):
-    df_global = pd.read_csv('data/global_data_lab.csv', sep=';')
-    df_global['lat'] = df_global['lat'].round(6)
-    df_global['lon'] = df_global['lon'].round(6)
-    df_global['urban_rural'] = df_global['urban_rural'].map({1: 'U', 2: 'R'})
+def number_missing_clusters_rowwise(cluster_ids):
+    ids = cluster_ids.astype(float)
+
+    cluster_id = 0
+    for i in range(len(ids)):
+        if isnan(ids.values[i]):
+            ids.iloc[i] = cluster_id
+            cluster_id += 1
+        else:
+            cluster_id = 0
 
-    df_petterson = read_petterson()
-    print(df_petterson)
-    df_sustain = read_sustain_bench()
-    print(df_sustain)
+    return ids
 
-    df_all = pd.concat([df_global, df_petterson, df_sustain], ignore_index=True)
 
-    df_all.drop_duplicates(['lat', 'lon'], inplace=True)
-    df_all.drop(['iwi'], axis=1, inplace=True)
+def number_missing_clusters(cluster_ids):
+    """
+    Number the clusters without a DHS id (Pettersson, SustainBench rows)
+    0, 1, 2... along each run of consecutive missing ids, the count
+    restarting after every row that has an id. Same numbering as
+    number_missing_clusters_rowwise, with a grouped cumulative count.
+    """
+    ids = cluster_ids.to_numpy(dtype=float, copy=True)
+    missing = np.isnan(ids)
+    runs = np.cumsum(~missing)[missing]
 
-    df_all['area_of_interest'] = df_all.apply(lambda x: area_of_interest(x['lat'],
-                                                                         x['lon'],
-                                                                         buffer),
-                                              axis=1)
+    ids[missing] = pd.Series(runs).groupby(runs).cumcount().to_numpy()
 
-    df_all['country'] = df_all['country'].str.lower()
+    return pd.Series(ids, index=cluster_ids.index, name=cluster_ids.name)
 
-    df_all.sort_values(['country', 'year'], inplace=True)
 
-    cluster_id = 0
-    for i in range(len(df_all)):
-        if isnan(df_all['cluster_id'].values[i]):
-            df_all['cluster_id'].iloc[i] = cluster_id
-            cluster_id += 1
-        else:
-            cluster_id = 0
+def get_all_aoi(buffer, csv=False, tolerance_km=TOLERANCE_KM, profile=None):
+    record = Profiler(profile).record('aoi', buffer=buffer)
 
-    df_all['cluster_id'] = df_all['cluster_id'].astype(int)
-    df_all['month'] = df_all['month'].astype(int)
+    with record.stage('read'):
+        df_global = read_global_data_lab().drop(columns=AOI_COLUMNS, errors='ignore')
 
-    df_all = df_all[['country', 'year', 'month', 'cluster_id', 'urban_rural', 'lat', 'lon', 'area_of_interest']]
+        df_petterson = read_petterson()
+        print(df_petterson)
+        df_sustain = read_sustain_bench()
+        print(df_sustain)
+
+    with record.stage('join'):
+        df_all = pd.concat([df_global, df_petterson, df_sustain], ignore_index=True)
+
+        df_all = spatial_drop_duplicates(df_all, tolerance_km)
+        df_all.drop(['iwi'], axis=1, inplace=True)
+
+    with record.stage('aoi'):
+        df_all[AOI_COLUMNS] = areas_of_interest(df_all['lat'].values,
+                                                df_all['lon'].values,
+                                                buffer)
+
+    with record.stage('cluster_ids'):
+        df_all['country'] = df_all['country'].str.lower()
+
+        df_all.sort_values(['country', 'year'], inplace=True)
+
+        df_all['cluster_id'] = number_missing_clusters(df_all['cluster_id']).astype(int)
+        df_all['year'] = df_all['year'].astype(int)
+        df_all['month'] = df_all['month'].astype(int)
+
+    df_all = df_all[['country', 'year', 'month', 'cluster_id', 'urban_rural', 'lat', 'lon'] + AOI_COLUMNS]
     df_all = df_all[df_all['country'] != 'egypt']
     df_all = df_all[df_all['country'] != 'morocco']
 
-    df_all.to_csv('data/areas_of_interest_month.csv', index=False, sep=';')
+    with record.stage('write'):
+        write_table(df_all, 'data/areas_of_interest_month', partition_cols=['country', 'year'], csv=csv)
+
+    record.emit(rows=len(df_all))
 
 
 if __name__ == "__main__":
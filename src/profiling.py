@@ -0,0 +1,216 @@
+import os
+import sys
+import json
+import time
+import resource
+import threading
+from contextlib import contextmanager, nullcontext
+
+import pandas as pd
+
+
+# Opt-in stage timing of the pipeline. Each survey, cluster or search is
+# a record with the wall time, bytes read from files, bytes received from
+# the network and peak memory of its stages, written as one JSON line when
+# it is done. File bytes and peak memory are counters of the whole
+# process, and of the worker processes of the dask distributed client if
+# there is one: with several clusters in flight they include the work of
+# the other threads. Network bytes are counted by the machine's network
+# interfaces, so they include the traffic of any other process.
+
+
+def disk_bytes_read():
+    """
+    Bytes the process read through read() calls (local files, pipes),
+    from /proc/self/io. Sockets (HTTP reads) are not counted, see
+    net_bytes_recv. None where it isn't available.
+    """
+    try:
+        with open('/proc/self/io') as f:
+            for line in f:
+                if line.startswith('rchar:'):
+                    return int(line.split()[1])
+    except OSError:
+        return None
+
+
+def net_bytes_recv(path='/proc/net/dev'):
+    """
+    Bytes received by the network interfaces other than loopback (the
+    dask workers talk over it), from /proc/net/dev. None where it isn't
+    available.
+    """
+    try:
+        with open(path) as f:
+            # two header lines, then 'interface: received bytes ...'
+            interfaces = [line.split(':', 1) for line in f.readlines()[2:]]
+    except OSError:
+        return None
+    return sum(int(counts.split()[0]) for name, counts in interfaces if name.strip() != 'lo')
+
+
+def peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, kilobytes on Linux
+    return round(peak / 1024 ** 2 if sys.platform == 'darwin' else peak / 1024, 1)
+
+
+def process_counters():
+    return os.getpid(), disk_bytes_read(), peak_rss_mb()
+
+
+def distributed_client():
+    """
+    Current dask distributed client, None without one or without
+    distributed installed.
+    """
+    try:
+        from distributed import default_client
+        return default_client()
+    except (ImportError, ValueError):
+        return None
+
+
+def counters():
+    """
+    Bytes read from files (None where unknown) and peak memory of this
+    process and the workers of the distributed client, summed and maxed
+    over the processes, and bytes received from the network. In-process
+    workers are only counted once.
+    """
+    pid, read, peak = process_counters()
+    processes = {pid: (read, peak)}
+    client = distributed_client()
+    if client is not None:
+        for pid, read, peak in client.run(process_counters).values():
+            processes[pid] = (read, peak)
+
+    reads = [read for read, _ in processes.values()]
+    return (None if None in reads else sum(reads), net_bytes_recv(),
+            max(peak for _, peak in processes.values()))
+
+
+def accumulate(previous, start, end):
+    # None as soon as a counter is unavailable
+    return None if None in (previous, start, end) else previous + end - start
+
+
+def to_json(value):
+    # numpy scalars of the task keys
+    return value.item() if hasattr(value, 'item') else str(value)
+
+
+class Record:
+    """
+    Stages of one survey, cluster or search. Stages may run in different
+    threads, the record is written by emit.
+    """
+
+    def __init__(self, profiler, kind, key):
+        self.profiler = profiler
+        self.kind = kind
+        self.key = key
+        self.stages = {}
+        self.start = time.perf_counter()
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        disk, net, _ = counters()
+        try:
+            yield
+        finally:
+            end_disk, end_net, peak = counters()
+            # a stage entered several times accumulates
+            previous = self.stages.get(name, {'seconds': 0, 'disk_bytes_read': 0, 'net_bytes_recv': 0})
+            self.stages[name] = {'seconds': round(previous['seconds'] + time.perf_counter() - start, 4),
+                                 'disk_bytes_read': accumulate(previous['disk_bytes_read'], disk, end_disk),
+                                 'net_bytes_recv': accumulate(previous['net_bytes_recv'], net, end_net),
+                                 'peak_rss_mb': peak}
+
+    def emit(self, **fields):
+        self.profiler.write({'kind': self.kind, **self.key, **fields,
+                             'seconds': round(time.perf_counter() - self.start, 4),
+                             'stages': self.stages})
+
+
+class NullRecord:
+    """
+    Record of a disabled profiler, does nothing.
+    """
+
+    def stage(self, name):
+        return nullcontext()
+
+    def emit(self, **fields):
+        pass
+
+
+NULL_RECORD = NullRecord()
+
+
+class Profiler:
+    """
+    Writes the records to the JSON lines file path, appending so worker
+    processes can share it. Disabled if path is None.
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self.lock = threading.Lock()
+
+        if path:
+            directory = os.path.dirname(path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+
+    def record(self, kind, **key):
+        if not self.path:
+            return NULL_RECORD
+        return Record(self, kind, key)
+
+    def write(self, line):
+        with self.lock:
+            with open(self.path, 'a') as f:
+                f.write(json.dumps(line, default=to_json) + '\n')
+
+    def summary(self):
+        return summarize(self.path) if self.path and os.path.exists(self.path) else pd.DataFrame()
+
+
+def read_records(path):
+    """
+    One row per record and stage of a JSON lines profile.
+    """
+    rows = []
+    with open(path) as f:
+        for line in f:
+            record = json.loads(line)
+            for stage, values in record.get('stages', {}).items():
+                # profiles written before the network counter
+                values.setdefault('disk_bytes_read', values.pop('bytes_read', None))
+                rows.append({'kind': record['kind'], 'stage': stage, **values})
+    return pd.DataFrame(rows, columns=['kind', 'stage', 'seconds', 'disk_bytes_read', 'net_bytes_recv', 'peak_rss_mb'])
+
+
+def summarize(path):
+    """
+    Count, total, mean, 95th percentile and max wall time, total bytes
+    read from files and received from the network and max peak memory of
+    every stage of a profile.
+    """
+    df = read_records(path)
+    grouped = df.groupby(['kind', 'stage'], sort=False)
+    return pd.DataFrame({'count': grouped['seconds'].count(),
+                         'total_s': grouped['seconds'].sum(),
+                         'mean_s': grouped['seconds'].mean(),
+                         'p95_s': grouped['seconds'].quantile(0.95),
+                         'max_s': grouped['seconds'].max(),
+                         'disk_read_mb': grouped['disk_bytes_read'].sum() / 1024 ** 2,
+                         'net_recv_mb': grouped['net_bytes_recv'].sum() / 1024 ** 2,
+                         'peak_rss_mb': grouped['peak_rss_mb'].max()}).round(3)
+
+
+if __name__ == '__main__':
+    pd.set_option('display.width', 200)
+    print(summarize(sys.argv[1]))
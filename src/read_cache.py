@@ -0,0 +1,226 @@
+import os
+import hashlib
+import warnings
+import threading
+from functools import lru_cache, partial
+from urllib.parse import urlsplit
+
+import numpy as np
+from rasterio.windows import Window
+from stackstac.nodata_reader import exception_matches, nodata_for_window
+from stackstac.raster_spec import RasterSpec
+from stackstac.rio_reader import AutoParallelRioReader
+
+
+class BlockCache:
+    """
+    Size-bounded on-disk LRU cache of raster blocks stored as .npy files.
+    Recency is the file mtime, refreshed on every hit, so the cache can be
+    shared by several processes and kept between runs.
+    """
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+        os.makedirs(directory, exist_ok=True)
+        self.size = sum(size for _, _, size in self.entries())
+
+    def entries(self):
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith('.npy'):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, entry.path, stat.st_size))
+        return entries
+
+    def path(self, key):
+        return os.path.join(self.directory, f'{key}.npy')
+
+    def get(self, key):
+        path = self.path(key)
+        try:
+            block = np.load(path)
+            os.utime(path)
+        except (FileNotFoundError, ValueError, OSError):
+            with self.lock:
+                self.misses += 1
+            return None
+
+        with self.lock:
+            self.hits += 1
+        return block
+
+    def put(self, key, block):
+        path = self.path(key)
+        tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            np.save(f, block)
+        # an overwritten block only adds the difference
+        try:
+            previous = os.path.getsize(path)
+        except FileNotFoundError:
+            previous = 0
+        os.replace(tmp_path, path)
+
+        with self.lock:
+            self.size += os.path.getsize(path) - previous
+            if self.size > self.max_bytes:
+                self.evict()
+
+    def evict(self):
+        # other processes write to the same directory, so re-read the real usage
+        entries = sorted(self.entries())
+        self.size = sum(size for _, _, size in entries)
+        for _, path, size in entries:
+            if self.size <= 0.9 * self.max_bytes:
+                break
+            try:
+                os.remove(path)
+                self.size -= size
+            except FileNotFoundError:
+                pass
+
+    def stats(self):
+        with self.lock:
+            requests = self.hits + self.misses
+            return {'hits': self.hits, 'misses': self.misses,
+                    'hit_rate': round(self.hits / requests, 3) if requests else 0.0,
+                    'bytes': self.size, 'max_bytes': self.max_bytes}
+
+
+@lru_cache(maxsize=None)
+def get_cache(directory, max_bytes):
+    """
+    Process-wide BlockCache of a directory.
+    """
+    return BlockCache(directory, max_bytes)
+
+
+class CachedRioReader(AutoParallelRioReader):
+    """
+    stackstac reader that serves windows from fixed-size blocks of the
+    global pixel grid of the output CRS and resolution, cached on disk.
+
+    stackstac snaps the stack bounds to multiples of the resolution, so
+    every cluster stacked with the same epsg/resolution shares this grid
+    and overlapping clusters ask for the same blocks of a scene.
+    """
+
+    def __init__(self, *, cache_dir, max_bytes, block_size=512, **kwargs):
+        super().__init__(**kwargs)
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.block_size = block_size
+        self._block_reader = None
+
+    @property
+    def cache(self):
+        return get_cache(self.cache_dir, self.max_bytes)
+
+    def grid_offset(self):
+        # global column/row of the stack's top left pixel, None if not on the grid
+        xres, yres = self.spec.resolutions_xy
+        col = self.spec.bounds[0] / xres
+        row = -self.spec.bounds[3] / yres
+        if not (np.isclose(col, round(col)) and np.isclose(row, round(row))):
+            return None
+        return round(col), round(row)
+
+    def block_reader(self, blocks_col, blocks_row):
+        # one reader over the block-aligned extent of the stack, opened once
+        if self._block_reader is None:
+            xres, yres = self.spec.resolutions_xy
+            size = self.block_size
+            bounds = (blocks_col[0] * size * xres, -(blocks_row[1] + 1) * size * yres,
+                      (blocks_col[1] + 1) * size * xres, -blocks_row[0] * size * yres)
+            self._block_reader = AutoParallelRioReader(
+                url=self.url,
+                spec=RasterSpec(epsg=self.spec.epsg, bounds=bounds, resolutions_xy=self.spec.resolutions_xy),
+                resampling=self.resampling,
+                dtype=self.dtype,
+                fill_value=self.fill_value,
+                scale_offset=self.scale_offset,
+                gdal_env=self.gdal_env,
+                # failures are handled by read_block, so fill blocks are never cached
+                errors_as_nodata=(),
+            )
+            self._block_origin = (blocks_col[0], blocks_row[0])
+        return self._block_reader
+
+    def block_key(self, block_col, block_row):
+        # signed hrefs change with every token, the asset is the url without query
+        parts = urlsplit(self.url)
+        href = parts._replace(query='', fragment='').geturl()
+        key = '|'.join(map(str, [href, self.spec.epsg, self.spec.resolutions_xy, self.block_size, block_col,
+                                 block_row, np.dtype(self.dtype).str, self.fill_value, self.scale_offset,
+                                 self.resampling]))
+        return hashlib.sha1(key.encode()).hexdigest()
+
+    def read_block(self, block_col, block_row, blocks_col, blocks_row):
+        key = self.block_key(block_col, block_row)
+        block = self.cache.get(key)
+        if block is None:
+            reader = self.block_reader(blocks_col, blocks_row)
+            origin_col, origin_row = self._block_origin
+            window = Window((block_col - origin_col) * self.block_size, (block_row - origin_row) * self.block_size,
+                            self.block_size, self.block_size)
+            try:
+                block = reader.read(window)
+            except RuntimeError as e:
+                # a transient error (503, timeout) must not leave a permanent hole in the shared cache
+                if not exception_matches(e.__cause__ or e, self.errors_as_nodata):
+                    raise
+                warnings.warn(str(e))
+                return nodata_for_window(window, self.fill_value, self.dtype)
+            self.cache.put(key, block)
+        return block
+
+    def read(self, window, **kwargs):
+        offset = self.grid_offset()
+        if offset is None or kwargs:
+            return super().read(window, **kwargs)
+
+        size = self.block_size
+        height, width = self.spec.shape
+        # blocks covering the whole stack, so the block reader extent is fixed per reader
+        blocks_col = (offset[0] // size, (offset[0] + width - 1) // size)
+        blocks_row = (offset[1] // size, (offset[1] + height - 1) // size)
+
+        col_start = offset[0] + int(window.col_off)
+        row_start = offset[1] + int(window.row_off)
+        col_stop = col_start + int(window.width)
+        row_stop = row_start + int(window.height)
+
+        result = np.empty((int(window.height), int(window.width)), dtype=self.dtype)
+        for block_row in range(row_start // size, (row_stop - 1) // size + 1):
+            for block_col in range(col_start // size, (col_stop - 1) // size + 1):
+                block = self.read_block(block_col, block_row, blocks_col, blocks_row)
+
+                c0, c1 = max(col_start, block_col * size), min(col_stop, (block_col + 1) * size)
+                r0, r1 = max(row_start, block_row * size), min(row_stop, (block_row + 1) * size)
+                result[r0 - row_start:r1 - row_start, c0 - col_start:c1 - col_start] = \
+                    block[r0 - block_row * size:r1 - block_row * size, c0 - block_col * size:c1 - block_col * size]
+
+        return result
+
+    def close(self):
+        super().close()
+        if self._block_reader is not None:
+            self._block_reader.close()
+            self._block_reader = None
+
+    def __getstate__(self):
+        return {**super().__getstate__(), 'cache_dir': self.cache_dir, 'max_bytes': self.max_bytes,
+                'block_size': self.block_size}
+
+
+def cached_reader(cache_dir, max_bytes, block_size=512):
+    """
+    Reader to pass to stackstac.stack so its windows go through the
+    on-disk block cache in cache_dir.
+    """
+    return partial(CachedRioReader, cache_dir=cache_dir, max_bytes=max_bytes, block_size=block_size)
@@ -0,0 +1,313 @@
+import os
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from src import test_mosaic, search_planner, read_cache, store, profiling, tile_catalog, append_log
+
+log = logging.getLogger(__name__)
+
+PENDING = 'pending'
+DONE = 'done'
+FAILED = 'failed'
+
+LEDGER_COLUMNS = ['country', 'year', 'cluster_id', 'status', 'attempts', 'items', 'error']
+
+
+class JobLedger:
+    """
+    Append-only record of the mosaic jobs, one ';' separated line per state
+    change. The last line of a job wins, so a crashed run is resumed by
+    reading the file back instead of scanning the output folders.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.jobs = {}
+        self.lock = threading.Lock()
+
+        for row in append_log.load(path, LEDGER_COLUMNS, self.parse):
+            self.jobs[self.key(row['country'], row['year'], row['cluster_id'])] = row
+
+    @staticmethod
+    def key(country, year, cluster_id):
+        return str(country), str(year), str(cluster_id)
+
+    @staticmethod
+    def parse(row):
+        """
+        Row read back from the file, None for a line cut short by a crash
+        (partial status or attempts), so the previous line of the job wins.
+        """
+        if row['status'] not in (PENDING, DONE, FAILED) or not row['attempts'].isdigit():
+            return None
+        row['attempts'] = int(row['attempts'])
+        return row
+
+    def _append(self, rows):
+        append_log.append(self.path, LEDGER_COLUMNS, rows)
+
+    def register(self, jobs):
+        """
+        Add (country, year, cluster_id, status) jobs that are not in the
+        ledger yet. Jobs already known keep their state.
+        """
+        new_rows = []
+        with self.lock:
+            for country, year, cluster_id, status in jobs:
+                key = self.key(country, year, cluster_id)
+                if key in self.jobs:
+                    continue
+                row = {'country': key[0], 'year': key[1], 'cluster_id': key[2], 'status': status,
+                       'attempts': 0, 'items': '', 'error': ''}
+                self.jobs[key] = row
+                new_rows.append(row)
+            if new_rows:
+                self._append(new_rows)
+        return len(new_rows)
+
+    def mark(self, country, year, cluster_id, status, items='', error=''):
+        with self.lock:
+            key = self.key(country, year, cluster_id)
+            row = dict(self.jobs[key], status=status, attempts=self.jobs[key]['attempts'] + 1,
+                       items=items, error=str(error).replace('\n', ' '))
+            self.jobs[key] = row
+            self._append([row])
+
+    def status(self, country, year, cluster_id):
+        return self.jobs[self.key(country, year, cluster_id)]['status']
+
+    def runnable(self, max_attempts):
+        return {key for key, row in self.jobs.items()
+                if row['status'] == PENDING or (row['status'] == FAILED and row['attempts'] < max_attempts)}
+
+    def counts(self):
+        counts = {PENDING: 0, DONE: 0, FAILED: 0}
+        for row in self.jobs.values():
+            counts[row['status']] += 1
+        return counts
+
+
+def existing_tiles(data_dir, folders):
+    """
+    Cluster ids of the tiles already written in each (country, year)
+    folder of data_dir, with one directory listing per folder.
+    """
+    tiles = {}
+    for country, year in folders:
+        folder = os.path.join(data_dir, str(country), str(year))
+        names = os.listdir(folder) if os.path.isdir(folder) else []
+        tiles[country, year] = {name[:-len('.tif')] for name in names if name.endswith('.tif')}
+    return tiles
+
+
+def plan_tasks(df, data_dir, ledger, max_attempts=3):
+    """
+    Mosaic tasks of an areas of interest table (see store.read_table),
+    one per country/year/cluster_id taking the first row of each, built in
+    a single pass. Clusters new to the ledger are registered, as done if
+    their tile already exists in data_dir/<country>/<year>.
+
+    Returns the tasks the ledger considers runnable, ready for run_mosaics
+    or any other executor.
+    """
+    clusters = df.drop_duplicates(['country', 'year', 'cluster_id'])
+    countries = clusters['country'].tolist()
+    years = clusters['year'].tolist()
+    cluster_ids = clusters['cluster_id'].tolist()
+    months = clusters['month'].tolist()
+    bboxes = store.bbox_tuples(clusters)
+
+    folders = dict.fromkeys(zip(countries, years))
+    tiles = existing_tiles(data_dir, folders)
+    output_paths = {}
+    for country, year in folders:
+        output_paths[country, year] = os.path.join(data_dir, str(country), str(year))
+        os.makedirs(output_paths[country, year], exist_ok=True)
+
+    tasks = []
+    new_jobs = []
+    for country, year, cluster_id, month, bbox in zip(countries, years, cluster_ids, months, bboxes):
+        tasks.append({'country': country, 'year': year, 'cluster_id': cluster_id, 'bbox': bbox,
+                      'month': month, 'output_path': output_paths[country, year]})
+
+        # tiles written before the ledger existed are only checked once, when the job is registered
+        if ledger.key(country, year, cluster_id) not in ledger.jobs:
+            exists = str(cluster_id) in tiles[country, year]
+            new_jobs.append((country, year, cluster_id, DONE if exists else PENDING))
+
+    registered = ledger.register(new_jobs)
+    runnable = ledger.runnable(max_attempts)
+    tasks = [task for task in tasks if ledger.key(task['country'], task['year'], task['cluster_id']) in runnable]
+    log.info(f'Planned {len(tasks)} runnable tasks out of {len(clusters)} clusters ({registered} new)')
+
+    return tasks
+
+
+def run_mosaics(tasks, ledger, cloud_cover=25, time_span=2, epsg=3857, workers=8, search_concurrency=4,
+                compute_concurrency=2, max_attempts=3, stac=None, batch_search=True, cell_size=5.0,
+                cache_dir=None, cache_bytes=50 * 1024 ** 3, catalog=None, profiler=None, chips=False,
+                region_size=0.5, region_dir='data/regions', keep_regions=False, **mosaic_options):
+    """
+    Run the cluster mosaics with up to `workers` clusters in flight.
+    STAC searches and raster computations are bounded separately, so a
+    slow search never blocks the compute slots and the other way around.
+
+    tasks: iterable of dicts with country, year, cluster_id, bbox, month
+    and output_path. Only jobs the ledger considers runnable are started.
+    stac: test_mosaic.StacClient shared by all workers, by default one
+    opened on the Planetary Computer with a pool sized for the searches.
+    batch_search: search once per country/year/grid cell group (see
+    search_planner.plan_searches) instead of once per cluster.
+    cache_dir: directory of the block cache shared by overlapping clusters
+    and later runs (see read_cache), None to read the assets directly.
+    catalog: tile_catalog.TileCatalog the written tiles are added to.
+    profiler: profiling.Profiler recording a line per cluster (search,
+    stack, compute and write stages) and per batched search.
+    chips: composite once per region instead of once per cluster. The
+    clusters of a country/year/time window in the same `region_size`
+    degree cell share a search and a mosaic written to region_dir, each
+    cluster tile is then cut out of it with a windowed read. The regional
+    mosaic is deleted afterwards unless keep_regions.
+    mosaic_options: compositing options passed on to
+    test_mosaic.mosaic_items (median_memory, qa_bits, clear_coverage...).
+    """
+    runnable = ledger.runnable(max_attempts)
+    tasks = [task for task in tasks
+             if ledger.key(task['country'], task['year'], task['cluster_id']) in runnable]
+
+    search_slots = threading.Semaphore(search_concurrency)
+    compute_slots = threading.Semaphore(compute_concurrency)
+
+    if stac is None:
+        stac = test_mosaic.StacClient(pool_size=max(search_concurrency, 10))
+
+    reader = read_cache.cached_reader(cache_dir, cache_bytes) if cache_dir else None
+
+    if profiler is None:
+        profiler = profiling.Profiler()
+    records = {ledger.key(task['country'], task['year'], task['cluster_id']):
+               profiler.record('cluster', country=task['country'], year=task['year'], cluster_id=task['cluster_id'])
+               for task in tasks}
+
+    def search(group):
+        record = profiler.record('search', country=group['tasks'][0]['country'], year=group['tasks'][0]['year'])
+        with search_slots, record.stage('search'):
+            assigned = search_planner.search_group(stac, group, cloud_cover)
+        record.emit(clusters=len(group['tasks']), items=len({item.id for items in assigned for item in items}))
+        return assigned
+
+    def run(task, items=None):
+        record = records[ledger.key(task['country'], task['year'], task['cluster_id'])]
+        if items is None:
+            with search_slots, record.stage('search'):
+                items = test_mosaic.search_items(stac, task['bbox'], task['year'], task['month'],
+                                                 cloud_cover, time_span)
+        with compute_slots:
+            info = test_mosaic.mosaic_items(items, task['cluster_id'], task['bbox'], task['output_path'], epsg,
+                                            stac.metrics, reader, record=record, **mosaic_options)
+        if catalog is not None:
+            catalog.add(task['country'], task['year'], task['cluster_id'], info)
+
+        return items
+
+    def run_region(group, assigned):
+        task = group['tasks'][0]
+        name = f"{task['country']}_{task['year']}_{group['cell'][0]}_{group['cell'][1]}_{group['datetime'][0]}"
+        record = profiler.record('region', country=task['country'], year=task['year'], region=name)
+
+        # every item of the group once, in search order
+        items = list({item.id: item for task_items in assigned for item in task_items}.values())
+        with compute_slots:
+            info = test_mosaic.mosaic_items(items, name, group['bbox'], region_dir, epsg, stac.metrics, reader,
+                                            record=record, **mosaic_options)
+        record.emit(clusters=len(group['tasks']), items=len(items))
+
+        results = []
+        for task, task_items in zip(group['tasks'], assigned):
+            file_path = os.path.join(task['output_path'], f"{task['cluster_id']}.tif")
+            try:
+                if len(task_items) == 0:
+                    raise ValueError('No items')
+                with records[ledger.key(task['country'], task['year'], task['cluster_id'])].stage('chip'):
+                    chip = test_mosaic.cut_chip(info['path'], task['bbox'], file_path, epsg,
+                                                mosaic_options.get('cog', False))
+                if catalog is not None:
+                    catalog.add(task['country'], task['year'], task['cluster_id'],
+                                tile_catalog.describe(chip, task_items, file_path, epsg, info['dtype']))
+                results.append((task, task_items, None))
+            except Exception as e:
+                results.append((task, None, e))
+
+        if not keep_regions:
+            os.remove(info['path'])
+
+        return results
+
+    def finish(task, items=None, error=None):
+        name = f"{task['country']}/{task['year']}/{task['cluster_id']}"
+        record = records[ledger.key(task['country'], task['year'], task['cluster_id'])]
+        if error is None:
+            ledger.mark(task['country'], task['year'], task['cluster_id'], DONE, items=len(items))
+            record.emit(status=DONE, items=len(items))
+            log.info(f'Processed {name} with {len(items)} items')
+        else:
+            ledger.mark(task['country'], task['year'], task['cluster_id'], FAILED, error=error)
+            record.emit(status=FAILED, error=str(error))
+            log.error(f'Error processing {name}: {error}')
+
+    log.info(f'Scheduling {len(tasks)} clusters with {workers} workers')
+
+    if chips:
+        os.makedirs(region_dir, exist_ok=True)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {}
+        regions = {}
+        if batch_search or chips:
+            if chips:
+                groups = search_planner.plan_searches(tasks, time_span, region_size, split_windows=True)
+            else:
+                groups = search_planner.plan_searches(tasks, time_span, cell_size)
+            log.info(f'Planned {len(groups)} searches for {len(tasks)} clusters')
+
+            searches = {executor.submit(search, group): group for group in groups}
+            for future in as_completed(searches):
+                group = searches[future]
+                try:
+                    assigned = future.result()
+                except Exception as e:
+                    for task in group['tasks']:
+                        finish(task, error=e)
+                    continue
+                if chips:
+                    regions[executor.submit(run_region, group, assigned)] = group
+                    continue
+                for task, items in zip(group['tasks'], assigned):
+                    futures[executor.submit(run, task, items)] = task
+        else:
+            futures = {executor.submit(run, task): task for task in tasks}
+
+        for future in as_completed(regions):
+            try:
+                results = future.result()
+            except Exception as e:
+                results = [(task, None, e) for task in regions[future]['tasks']]
+            for task, items, error in results:
+                finish(task, items=items, error=error)
+
+        for future in as_completed(futures):
+            task = futures[future]
+            try:
+                finish(task, items=future.result())
+            except Exception as e:
+                finish(task, error=e)
+
+    log.info(f'STAC metrics: {stac.metrics.summary()}')
+    if profiler.path:
+        log.info(f'Stage profile ({profiler.path}):\n{profiler.summary()}')
+    if cache_dir:
+        # hits and misses of this process, Dask workers keep their own counters
+        log.info(f'Read cache: {read_cache.get_cache(cache_dir, cache_bytes).stats()}')
+
+    return ledger.counts()
@@ -0,0 +1,84 @@
+import math
+from datetime import datetime
+
+import numpy as np
+import pystac
+from shapely import STRtree, box
+from shapely.geometry import shape
+
+from src import test_mosaic
+
+
+def plan_searches(tasks, time_span=2, cell_size=5.0, split_windows=False):
+    """
+    Group cluster tasks into batched STAC searches. Clusters of the same
+    country and year whose boxes fall into the same `cell_size` degree
+    grid cell share one search over the union of their boxes and time
+    windows. With split_windows, only clusters with the same time window
+    are grouped, so a group can share one composite.
+
+    Returns a list of groups, dicts with the union bbox, datetime range
+    and the tasks with their own time window.
+    """
+    groups = {}
+
+    for task in tasks:
+        xmin, ymin, xmax, ymax = task['bbox']
+        cell = (math.floor((xmin + xmax) / 2 / cell_size), math.floor((ymin + ymax) / 2 / cell_size))
+        date_min, date_max = test_mosaic.compute_time_frame_centered(f"{task['year']}-{task['month']}-01",
+                                                                     365 * time_span)
+
+        key = (task['country'], task['year'], cell) + ((date_min, date_max) if split_windows else ())
+        group = groups.setdefault(key, {'tasks': [], 'windows': [], 'cell': cell})
+        group['tasks'].append(task)
+        group['windows'].append((date_min, date_max))
+
+    for group in groups.values():
+        bboxes = np.array([task['bbox'] for task in group['tasks']], dtype=float)
+        group['bbox'] = (*bboxes[:, :2].min(axis=0), *bboxes[:, 2:].max(axis=0))
+        group['datetime'] = (min(window[0] for window in group['windows']),
+                             max(window[1] for window in group['windows']))
+
+    return list(groups.values())
+
+
+def assign_items(items, group):
+    """
+    Give each task of the group the items whose footprint intersects its
+    bbox and whose acquisition date is inside its time window, in the
+    order the search returned them.
+    """
+    footprints = [shape(item.geometry) for item in items]
+    tree = STRtree(footprints)
+    dates = [item.datetime.date() for item in items]
+
+    assigned = []
+    for task, (date_min, date_max) in zip(group['tasks'], group['windows']):
+        date_min = datetime.strptime(date_min, '%Y-%m-%d').date()
+        date_max = datetime.strptime(date_max, '%Y-%m-%d').date()
+        hits = np.sort(tree.query(box(*task['bbox']), predicate='intersects'))
+        assigned.append(pystac.ItemCollection([items[i] for i in hits if date_min <= dates[i] <= date_max]))
+
+    return assigned
+
+
+def search_group(stac, group, cloud_cover=25):
+    """
+    Run the batched search of a group and split the items between its
+    tasks. Returns one ItemCollection per task.
+    """
+    date_min, date_max = group['datetime']
+
+    with stac.metrics.timer('search'):
+        search = stac.catalog.search(
+            bbox=group['bbox'],
+            datetime=f"{date_min}/{date_max}",
+            collections=["landsat-c2-l2"],
+            query={"eo:cloud_cover": {"lt": cloud_cover}},
+        )
+
+        items = list(search.items())
+
+    stac.metrics.count('searches')
+
+    return assign_items(items, group)
@@ -0,0 +1,139 @@
+import numpy as np
+import pandas as pd
+from sklearn.neighbors import BallTree
+
+
+# Matching of cluster locations between label sources (Global Data Lab,
+# Pettersson, SustainBench) by haversine distance instead of exact
+# equality of rounded coordinates.
+
+EARTH_RADIUS_KM = 6371.0088
+TOLERANCE_KM = 0.01
+
+
+def to_radians(df, lat='lat', lon='lon'):
+    return np.radians(df[[lat, lon]].to_numpy(dtype=float))
+
+
+def located(points):
+    # rows with both coordinates, BallTree rejects NaN
+    return np.isfinite(points).all(axis=1)
+
+
+def search_bounds(df, tolerance_km=TOLERANCE_KM):
+    """
+    (xmin, ymin, xmax, ymax) lon/lat box holding every point within
+    tolerance_km of a row of df, with some margin. None for an empty df.
+    """
+    if len(df) == 0:
+        return None
+
+    lats, lons = df['lat'].to_numpy(dtype=float), df['lon'].to_numpy(dtype=float)
+    margin = 2 * np.degrees(tolerance_km / EARTH_RADIUS_KM)
+    # a degree of longitude shrinks away from the equator
+    lon_margin = margin / max(np.cos(np.radians(min(np.nanmax(np.abs(lats)) + margin, 89.0))), 1e-3)
+
+    return (np.nanmin(lons) - lon_margin, np.nanmin(lats) - margin, np.nanmax(lons) + lon_margin,
+            np.nanmax(lats) + margin)
+
+
+def nearest_pairs(left, right, tolerance_km=TOLERANCE_KM, k=4):
+    """
+    One to one matching of the rows of two dataframes with lat/lon
+    columns. Each left row is matched to at most one right row and the
+    other way around, closest pairs first, among the k nearest neighbours
+    within tolerance_km.
+
+    Returns the positional left and right indices of the pairs and their
+    distance in km. Rows without coordinates are never matched.
+    """
+    left_points, right_points = to_radians(left), to_radians(right)
+    left_rows, right_rows = np.flatnonzero(located(left_points)), np.flatnonzero(located(right_points))
+    if len(left_rows) == 0 or len(right_rows) == 0:
+        return np.array([], dtype=int), np.array([], dtype=int), np.array([])
+
+    tree = BallTree(right_points[right_rows], metric='haversine')
+    distances, indices = tree.query(left_points[left_rows], k=min(k, len(right_rows)))
+    distances = distances * EARTH_RADIUS_KM
+
+    left_index = np.repeat(left_rows, indices.shape[1])
+    right_index = right_rows[indices.ravel()]
+    distances = distances.ravel()
+
+    close = distances <= tolerance_km
+    left_index, right_index, distances = left_index[close], right_index[close], distances[close]
+
+    # greedy one to one assignment, closest pairs first, ties in left order
+    order = np.lexsort((left_index, distances))
+    left_used = np.zeros(len(left), dtype=bool)
+    right_used = np.zeros(len(right), dtype=bool)
+    keep = np.zeros(len(order), dtype=bool)
+    for n, i in enumerate(order):
+        if not left_used[left_index[i]] and not right_used[right_index[i]]:
+            left_used[left_index[i]] = right_used[right_index[i]] = True
+            keep[n] = True
+
+    pairs = np.sort(order[keep])
+    return left_index[pairs], right_index[pairs], distances[pairs]
+
+
+def spatial_join(left, right, tolerance_km=TOLERANCE_KM, how='inner', suffixes=('_x', '_y'), k=4):
+    """
+    Like pd.merge(left, right, on=['lat', 'lon'], how=how) with matching
+    coordinates within tolerance_km of each other, one to one. The lat/lon
+    of the left rows are kept and the match distance is added as
+    distance_km. how is 'inner' or 'left'.
+    """
+    left_index, right_index, distances = nearest_pairs(left, right, tolerance_km, k)
+
+    if how == 'left':
+        matched = np.full(len(left), -1)
+        matched[left_index] = right_index
+        distance = np.full(len(left), np.nan)
+        distance[left_index] = distances
+        left_index = np.arange(len(left))
+        right_index = matched
+        distances = distance
+    elif how != 'inner':
+        raise ValueError(f'Unsupported join: {how}')
+
+    left_part = left.iloc[left_index].reset_index(drop=True)
+    # unmatched left rows (how='left') get missing values on the right
+    matched = right_index >= 0
+    right_part = right.drop(columns=['lat', 'lon']).iloc[right_index[matched]]
+    right_part = right_part.set_axis(np.flatnonzero(matched)).reindex(range(len(left_index)))
+
+    common = left_part.columns.intersection(right_part.columns)
+    left_part = left_part.rename(columns={column: column + suffixes[0] for column in common})
+    right_part = right_part.rename(columns={column: column + suffixes[1] for column in common})
+
+    output = pd.concat([left_part, right_part], axis=1)
+    output['distance_km'] = distances
+
+    return output
+
+
+def spatial_drop_duplicates(df, tolerance_km=TOLERANCE_KM):
+    """
+    Like df.drop_duplicates(['lat', 'lon']), treating as duplicates the
+    rows within tolerance_km of an earlier row that is kept. Rows without
+    coordinates are all kept.
+    """
+    points = to_radians(df)
+    rows = np.flatnonzero(located(points))
+    if len(rows) == 0:
+        return df.copy()
+
+    points = points[rows]
+    neighbours = BallTree(points, metric='haversine').query_radius(points, r=tolerance_km / EARTH_RADIUS_KM)
+
+    # every point is its own neighbour, only the others can drop rows
+    crowded = np.flatnonzero([len(close) > 1 for close in neighbours])
+
+    dropped = np.zeros(len(df), dtype=bool)
+    for i in crowded:
+        if not dropped[rows[i]]:
+            close = neighbours[i]
+            dropped[rows[close[close > i]]] = True
+
+    return df[~dropped].copy()
@@ -0,0 +1,142 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+
+# Train/test and k-fold splits of the cluster table that keep neighbouring
+# clusters together. Clusters are grouped into blocks of a lat/lon grid
+# (and optionally of their country), whole blocks are assigned to folds,
+# balancing the label distribution of the folds. The table is read twice
+# in chunks, counting the clusters of every block first and writing the
+# rows of each fold second, so it never has to fit in memory.
+
+IWI_BINS = [0, 20, 40, 60, 80, 100]
+BLOCK_COLUMNS = ['block_country', 'block_y', 'block_x']
+
+
+def block_index(df, block_size=0.5, by_country=False):
+    """
+    Block of every row as block_country, block_y and block_x columns:
+    the block_size degree grid cell of its lat/lon, within its country
+    with by_country. block_size None makes every country a single block.
+    """
+    blocks = pd.DataFrame(index=df.index)
+    blocks['block_country'] = df['country'].astype(str) if by_country or block_size is None else ''
+    if block_size is None:
+        blocks['block_y'] = blocks['block_x'] = 0
+    else:
+        # rows without coordinates share one block
+        blocks['block_y'] = np.floor(df['lat'] / block_size).fillna(np.iinfo('int32').min).astype('int32')
+        blocks['block_x'] = np.floor(df['lon'] / block_size).fillna(np.iinfo('int32').min).astype('int32')
+    return blocks
+
+
+def label_bins(labels, bins=IWI_BINS):
+    # labels outside the edges fall into the first and last bins, missing ones in their own
+    codes = np.digitize(labels.clip(bins[0], bins[-1]), bins[1:-1])
+    return np.where(labels.isna(), len(bins) - 1, codes)
+
+
+def count_blocks(dataset_csv, label='iwi', block_size=0.5, by_country=False, bins=IWI_BINS, chunksize=100_000):
+    """
+    Rows of every block and label bin of dataset_csv, one block per row
+    and one column per bin.
+    """
+    counts = []
+    for chunk in pd.read_csv(dataset_csv, sep=';', chunksize=chunksize):
+        blocks = block_index(chunk, block_size, by_country)
+        blocks['bin'] = label_bins(chunk[label], bins)
+        counts.append(blocks.value_counts())
+
+    counts = pd.concat(counts).groupby(level=BLOCK_COLUMNS + ['bin']).sum()
+    return counts.unstack('bin', fill_value=0).reindex(columns=range(len(bins)), fill_value=0)
+
+
+def assign_folds(counts, weights, seed=0):
+    """
+    Fold of every block of count_blocks, for folds taking the weights
+    fractions of the rows. Blocks are assigned largest first, to the fold
+    that keeps the label bins of all the folds closest to their targets,
+    ties broken at random with seed.
+    """
+    rng = np.random.default_rng(seed)
+    weights = np.asarray(weights, dtype=float) / np.sum(weights)
+    values = counts.to_numpy(dtype=float)
+    targets = weights[:, None] * values.sum(axis=0)
+
+    # random order first, so the stable sort breaks size ties at random
+    order = rng.permutation(len(values))
+    order = order[np.argsort(-values[order].sum(axis=1), kind='stable')]
+
+    folds = np.zeros(len(values), dtype=int)
+    filled = np.zeros_like(targets)
+    for block in order:
+        # squared distance to the targets with the block in each fold, as a change from the current one
+        cost = ((filled + values[block] - targets) ** 2 - (filled - targets) ** 2).sum(axis=1)
+        candidates = np.flatnonzero(cost == cost.min())
+        fold = candidates[rng.integers(len(candidates))]
+        folds[block] = fold
+        filled[fold] += values[block]
+
+    return pd.Series(folds, index=counts.index, name='fold')
+
+
+def split(dataset_csv, output_path, names, weights, label='iwi', block_size=0.5, by_country=False, bins=IWI_BINS,
+          seed=0, chunksize=100_000):
+    """
+    Write the rows of dataset_csv to output_path/<name>.csv for each of
+    the folds `names`, taking the `weights` fractions of the rows, with
+    whole blocks (see block_index) in every fold and the label bins
+    balanced across folds. The same seed gives the same split.
+
+    Returns the rows and label bins of every fold.
+    """
+    counts = count_blocks(dataset_csv, label, block_size, by_country, bins, chunksize)
+    folds = assign_folds(counts, weights, seed)
+
+    os.makedirs(output_path, exist_ok=True)
+    paths = [os.path.join(output_path, f'{name}.csv') for name in names]
+    header = [True] * len(names)
+    for path in paths:
+        if os.path.exists(path):
+            os.remove(path)
+
+    for chunk in pd.read_csv(dataset_csv, sep=';', chunksize=chunksize):
+        chunk_folds = folds.reindex(pd.MultiIndex.from_frame(block_index(chunk, block_size, by_country))).values
+        for fold, path in enumerate(paths):
+            rows = chunk[chunk_folds == fold]
+            if len(rows):
+                rows.to_csv(path, index=False, sep=';', mode='a', header=header[fold])
+                header[fold] = False
+
+    # folds without rows still get a header
+    columns = pd.read_csv(dataset_csv, sep=';', nrows=0)
+    for fold, path in enumerate(paths):
+        if header[fold]:
+            columns.to_csv(path, index=False, sep=';')
+
+    summary = counts.groupby(folds).sum().reindex(range(len(names)), fill_value=0)
+    summary.columns = [f'bin_{column}' for column in summary.columns]
+    summary.insert(0, 'blocks', folds.value_counts().reindex(range(len(names)), fill_value=0))
+    summary.insert(1, 'rows', summary.filter(like='bin_').sum(axis=1))
+    summary.index = pd.Index(names, name='fold')
+
+    print(summary)
+
+    return summary
+
+
+def train_test_split(dataset_csv, output_path, train_ratio=0.8, **options):
+    """
+    train.csv and test.csv of dataset_csv (see split for the options).
+    """
+    return split(dataset_csv, output_path, ['train', 'test'], [train_ratio, 1 - train_ratio], **options)
+
+
+def k_fold_split(dataset_csv, output_path, k=5, **options):
+    """
+    fold_0.csv ... fold_<k-1>.csv of equal size (see split for the
+    options).
+    """
+    return split(dataset_csv, output_path, [f'fold_{n}' for n in range(k)], [1] * k, **options)
@@ -0,0 +1,126 @@
+import os
+import shutil
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+
+# Parquet storage of the tables handed between the pipeline stages.
+# Tables are addressed by path without extension: <path>.parquet for a
+# single file, <path>/ for a dataset partitioned by country/year. The
+# area of interest is stored as four float columns instead of a
+# stringified list, the ';' separated CSV stays available as an export.
+
+AOI_COLUMNS = ['xmin', 'ymin', 'xmax', 'ymax']
+
+
+def to_bbox_columns(df, column='area_of_interest'):
+    """
+    Replace a column of [xmin, ymin, xmax, ymax] lists by four float
+    columns at the same position.
+    """
+    if column not in df.columns:
+        return df
+
+    position = df.columns.get_loc(column)
+    bounds = np.array(df[column].tolist(), dtype=float).reshape(-1, 4)
+    df = df.drop(columns=column)
+    for i, name in enumerate(AOI_COLUMNS):
+        df.insert(position + i, name, bounds[:, i])
+
+    return df
+
+
+def to_bbox_list(df, column='area_of_interest'):
+    """
+    Inverse of to_bbox_columns, for the CSV exports.
+    """
+    if not set(AOI_COLUMNS).issubset(df.columns):
+        return df
+
+    position = df.columns.get_loc(AOI_COLUMNS[0])
+    bounds = df[AOI_COLUMNS].values.tolist()
+    df = df.drop(columns=AOI_COLUMNS)
+    df.insert(position, column, bounds)
+
+    return df
+
+
+def bbox_tuples(df):
+    """
+    Area of interest of every row as a (xmin, ymin, xmax, ymax) tuple.
+    """
+    return list(map(tuple, df[AOI_COLUMNS].to_numpy(dtype=float).tolist()))
+
+
+def write_table(df, path, partition_cols=None, csv=False):
+    """
+    Write df to <path>.parquet, or to the <path>/ dataset partitioned by
+    partition_cols, replacing any previous version. With csv, also export
+    it to <path>.csv.
+    """
+    df = to_bbox_columns(df)
+
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+
+    if partition_cols:
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        df.to_parquet(path, partition_cols=partition_cols, index=False)
+    else:
+        df.to_parquet(f'{path}.parquet', index=False)
+
+    if csv:
+        export_csv(df, f'{path}.csv')
+
+
+def read_table(path, columns=None, filters=None):
+    """
+    Read a table written by write_table. filters are pyarrow filters, e.g.
+    [('country', '=', 'angola')], and only read the matching partitions.
+    """
+    if os.path.isdir(path):
+        df = pd.read_parquet(path, columns=columns, filters=filters)
+        # partition columns come back as categoricals
+        for column in df.select_dtypes('category').columns:
+            df[column] = df[column].astype(df[column].cat.categories.dtype)
+        return df
+
+    return pd.read_parquet(f'{path}.parquet', columns=columns, filters=filters)
+
+
+def export_csv(df, path):
+    to_bbox_list(df).to_csv(path, index=False, sep=';')
+
+
+def concat_files(paths, path, read=pd.read_parquet, csv=False):
+    """
+    Concatenate parquet files into <path>.parquet (and <path>.csv with
+    csv) one file at a time, so only one of them is ever in memory.
+    read(file) returns the dataframe appended for a file.
+    The schemas are unified from the file footers first: integers are
+    widened and columns missing from a file are left empty.
+
+    Returns the number of rows appended from each file.
+    """
+    schema = pa.unify_schemas([pq.read_schema(file).remove_metadata() for file in paths],
+                              promote_options='permissive') if paths else pa.schema([])
+
+    tmp_path = f'{path}.parquet.tmp'
+    rows = []
+    with pq.ParquetWriter(tmp_path, schema) as writer:
+        for n, file in enumerate(paths):
+            df = read(file).reindex(columns=schema.names)
+            writer.write_table(pa.Table.from_pandas(df, schema=schema, preserve_index=False))
+            if csv:
+                to_bbox_list(df).to_csv(f'{path}.csv', index=False, sep=';', mode='w' if n == 0 else 'a',
+                                        header=n == 0)
+            rows.append(len(df))
+
+    os.replace(tmp_path, f'{path}.parquet')
+
+    return rows
@@ -0,0 +1,289 @@
+import os
+import json
+import threading
+from datetime import datetime
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import pyreadstat
+import pystac
+import rasterio
+from pyproj import Transformer
+from rasterio.transform import from_origin
+from shapely.geometry import box, mapping
+
+from src.compute_IWI import toilet_quality, water_quality, floor_quality
+from src.process_IWI import CNAMES
+from src.store import write_table
+from src.tile_catalog import TileCatalog
+from src.utils import areas_of_interest
+
+
+# Synthetic inputs for the benchmarks and tests: household recodes, DHS
+# survey folders, the label sources read by get_all_aoi, Landsat like
+# COG scenes served by a local STAC API and cluster tiles, so the whole
+# pipeline runs offline.
+
+# scenes are laid out in UTM 33S around this point (Angola)
+ORIGIN_LON, ORIGIN_LAT = 13.5, -12.35
+SCENE_EPSG = 32733
+
+LANDSAT_BANDS = ['red', 'green', 'blue', 'nir08']
+LANDSAT_SCALE, LANDSAT_OFFSET = 2.75e-05, -0.2
+
+
+def cluster_locations(n, seed=0, spread=0.08):
+    """
+    n cluster coordinates within `spread` degrees of the scenes origin.
+    """
+    rng = np.random.default_rng(seed)
+    return (ORIGIN_LAT + rng.uniform(-spread, spread, n).round(6),
+            ORIGIN_LON + rng.uniform(-spread, spread, n).round(6))
+
+
+def households(n, seed=0):
+    """
+    Generate a household recode with the columns used by compute_IWI.
+    Quality codes include values outside the known categories so the
+    'missing' branch is exercised too.
+    """
+    rng = np.random.default_rng(seed)
+    df = pd.DataFrame({asset: rng.integers(0, 2, n) for asset in
+                       ['television', 'refrigerator', 'telephone', 'car', 'bicycle', 'electricity', 'motorboat',
+                        'computer', 'motorcycle', 'radio', 'watch', 'mobile_phone']})
+
+    for column, quality in [('toilet_quality', toilet_quality), ('water_quality', water_quality),
+                            ('floor_quality', floor_quality)]:
+        codes = np.unique(np.concatenate([quality['low'], quality['medium'], quality['high'], [97, 99]]))
+        df[column] = rng.choice(codes, n)
+
+    df['sleeping_rooms'] = rng.integers(0, 6, n)
+
+    return df
+
+
+def write_surveys(data_path, n_clusters, households=5, clusters_per_survey=1000, seed=0):
+    """
+    DHS survey folders data_path/<country>/<year> with a household recode
+    (.DTA), an IWI file (.sav) and a GPS shapefile, n_clusters clusters of
+    `households` households in total. Returns the (folder_path, country,
+    year) of every survey, as process_dhs.main takes them.
+    """
+    rng = np.random.default_rng(seed)
+    countries = sorted(CNAMES.values())
+    surveys = []
+
+    for n, start in enumerate(range(0, n_clusters, clusters_per_survey)):
+        clusters = min(clusters_per_survey, n_clusters - start)
+        country, year = countries[n % len(countries)], str(2000 + n // len(countries))
+        folder = os.path.join(data_path, country, year)
+        os.makedirs(folder, exist_ok=True)
+
+        cluster_ids = np.repeat(np.arange(1, clusters + 1), households)
+        hhid = [f'{cluster:8d}{household:4d}' for cluster, household in
+                zip(cluster_ids, np.tile(np.arange(1, households + 1), clusters))]
+        survey = pd.DataFrame({'hv006': rng.integers(1, 13, len(hhid)).astype(float),
+                               'hv007': float(year),
+                               'hhid': hhid,
+                               'hv001': cluster_ids.astype(float),
+                               'hv025': rng.integers(1, 3, len(hhid)).astype(float)})
+        pyreadstat.write_dta(survey, os.path.join(folder, 'SYHR01FL.DTA'))
+
+        iwi = pd.DataFrame({'HHID': hhid, 'iwi': rng.uniform(0, 100, len(hhid)).round(2)})
+        pyreadstat.write_sav(iwi, os.path.join(folder, 'SYIW01FL.sav'))
+
+        lats, lons = cluster_locations(clusters, seed + n)
+        gps = gpd.GeoDataFrame({'DHSCLUST': np.arange(1, clusters + 1).astype(float), 'LATNUM': lats, 'LONGNUM': lons},
+                               geometry=gpd.points_from_xy(lons, lats), crs='EPSG:4326')
+        gps.to_file(os.path.join(folder, 'SYGE01FL.shp'))
+
+        surveys.append((os.path.join(data_path, country), country, year))
+
+    return surveys
+
+
+def write_label_sources(data_path, n_clusters, seed=0):
+    """
+    The inputs of process_IWI.get_all_aoi for n_clusters clusters: the
+    global data lab table and the Pettersson and SustainBench csv files,
+    each of the latter two covering half of the clusters with half of
+    them at the locations of global data lab clusters.
+    """
+    rng = np.random.default_rng(seed)
+    lats, lons = cluster_locations(n_clusters, seed)
+    countries = rng.choice(sorted(CNAMES.values()), n_clusters)
+    years = rng.integers(2000, 2020, n_clusters)
+
+    global_data_lab = pd.DataFrame({'country': countries, 'month': rng.integers(1, 13, n_clusters),
+                                    'year': years, 'cluster_id': np.arange(n_clusters),
+                                    'urban_rural': rng.integers(1, 3, n_clusters), 'lat': lats, 'lon': lons,
+                                    'iwi': rng.uniform(0, 100, n_clusters)})
+    global_data_lab['area_of_interest'] = areas_of_interest(lats, lons, 5).tolist()
+    write_table(global_data_lab, os.path.join(data_path, 'global_data_lab'))
+
+    half = n_clusters // 2
+    shared = rng.choice(n_clusters, half // 2, replace=False)
+    other_lats, other_lons = cluster_locations(half - len(shared), seed + 1)
+    lats = np.concatenate([global_data_lab['lat'].values[shared], other_lats])
+    lons = np.concatenate([global_data_lab['lon'].values[shared], other_lons])
+
+    pd.DataFrame({'country': rng.choice(sorted(CNAMES.values()), half), 'year': rng.integers(2000, 2020, half),
+                  'rural': rng.integers(0, 2, half), 'lat': lats, 'lon': lons,
+                  'iwi': rng.uniform(0, 100, half)}).to_csv(os.path.join(data_path, 'dhs_clusters_rounded.csv'),
+                                                            index=False)
+
+    pd.DataFrame({'cname': rng.choice(sorted(CNAMES), half), 'year': rng.integers(2000, 2020, half),
+                  'cluster_id': np.arange(half), 'urban': rng.integers(0, 2, half), 'lat': lats[::-1],
+                  'lon': lons[::-1], 'asset_index': rng.normal(0, 1, half)}).to_csv(
+        os.path.join(data_path, 'dhs_final_labels.csv'), index=False)
+
+
+def write_scenes(directory, dates, grid=2, size=512, bands=LANDSAT_BANDS, seed=0):
+    """
+    A grid x grid mosaic of size x size Landsat C2 L2 like COG scenes
+    (uint16 surface reflectance bands with their raster:bands scale and
+    offset, and a QA_PIXEL band flagging ~20% of the pixels as cloud)
+    centered on the origin, for each date. Returns the STAC items.
+    """
+    rng = np.random.default_rng(seed)
+    os.makedirs(directory, exist_ok=True)
+
+    to_utm = Transformer.from_crs(4326, SCENE_EPSG, always_xy=True)
+    to_lonlat = Transformer.from_crs(SCENE_EPSG, 4326, always_xy=True)
+    x, y = to_utm.transform(ORIGIN_LON, ORIGIN_LAT)
+    extent = size * 30
+    x0, y0 = round(x - grid * extent / 2, -1), round(y + grid * extent / 2, -1)
+
+    items = []
+    for date in dates:
+        for row in range(grid):
+            for column in range(grid):
+                left, top = x0 + column * extent, y0 - row * extent
+                transform = from_origin(left, top, 30, 30)
+                lon_min, lat_min = to_lonlat.transform(left, top - extent)
+                lon_max, lat_max = to_lonlat.transform(left + extent, top)
+                item_id = f'LC08_SYN_{row}{column}_{date:%Y%m%d}'
+
+                item = pystac.Item(id=item_id, geometry=mapping(box(lon_min, lat_min, lon_max, lat_max)),
+                                   bbox=[lon_min, lat_min, lon_max, lat_max], datetime=date,
+                                   properties={'platform': 'landsat-8', 'proj:epsg': SCENE_EPSG,
+                                               'eo:cloud_cover': float(rng.uniform(0, 20))})
+
+                for band in list(bands) + ['qa_pixel']:
+                    if band == 'qa_pixel':
+                        array = np.where(rng.random((size, size)) < 0.2, 1 << 3, 1 << 6).astype('uint16')
+                        raster_bands = [{}]
+                    else:
+                        array = rng.integers(7273, 43636, (size, size)).astype('uint16')
+                        raster_bands = [{'scale': LANDSAT_SCALE, 'offset': LANDSAT_OFFSET}]
+
+                    path = os.path.join(directory, f'{item_id}_{band}.tif')
+                    with rasterio.open(path, 'w', driver='COG', height=size, width=size, count=1, dtype='uint16',
+                                       crs=f'EPSG:{SCENE_EPSG}', transform=transform, compress='DEFLATE') as dst:
+                        dst.write(array, 1)
+
+                    item.add_asset(band, pystac.Asset(
+                        href=path, media_type=pystac.MediaType.COG, roles=['data'],
+                        extra_fields={'proj:shape': [size, size], 'proj:transform': list(transform)[:6],
+                                      'raster:bands': raster_bands}))
+
+                items.append(item)
+
+    return items
+
+
+class LocalStac:
+    """
+    Minimal STAC API serving items on localhost: the landing page and an
+    item search by bbox, datetime and 'lt'/'gt' queries, without paging.
+    Usable as a context manager.
+    """
+
+    def __init__(self, items):
+        features = [item.to_dict() for item in items]
+        boxes = [box(*item.bbox) for item in items]
+        dates = [item.datetime.replace(tzinfo=None) for item in items]
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def log_message(self, *args):
+                pass
+
+            def send(self, body):
+                data = json.dumps(body).encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_GET(self):
+                root = f'http://127.0.0.1:{self.server.server_port}'
+                self.send({'type': 'Catalog', 'id': 'synthetic', 'stac_version': '1.0.0',
+                           'description': 'Synthetic Landsat scenes',
+                           'conformsTo': ['https://api.stacspec.org/v1.0.0/core',
+                                          'https://api.stacspec.org/v1.0.0/item-search',
+                                          'https://api.stacspec.org/v1.0.0/item-search#query'],
+                           'links': [{'rel': 'self', 'href': f'{root}/'}, {'rel': 'root', 'href': f'{root}/'},
+                                     {'rel': 'search', 'href': f'{root}/search', 'method': 'POST',
+                                      'type': 'application/geo+json'}]})
+
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+                self.send({'type': 'FeatureCollection', 'links': [],
+                           'features': [features[i] for i in range(len(features)) if matches(i, body)]})
+
+        def matches(i, body):
+            if 'bbox' in body and not boxes[i].intersects(box(*body['bbox'])):
+                return False
+            if 'datetime' in body:
+                start, end = (datetime.fromisoformat(value[:10]) for value in body['datetime'].split('/'))
+                if not start <= dates[i] <= end.replace(hour=23, minute=59, second=59):
+                    return False
+            for name, conditions in body.get('query', {}).items():
+                value = features[i]['properties'].get(name)
+                if 'lt' in conditions and not value < conditions['lt']:
+                    return False
+                if 'gt' in conditions and not value > conditions['gt']:
+                    return False
+            return True
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = f'http://127.0.0.1:{self.server.server_port}/'
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def write_tiles(data_path, n, bands=5, size=(205, 210), catalog_path=None, seed=0):
+    """
+    n float32 cluster tiles of size[0] to size[1] pixels a side under
+    data_path/angola/2010, added to the tile catalog at catalog_path if
+    given, and the ';' separated dataset listing them with an iwi label,
+    as chip_store.pack takes it. Returns the dataset path.
+    """
+    rng = np.random.default_rng(seed)
+    folder = os.path.join(data_path, 'angola', '2010')
+    os.makedirs(folder, exist_ok=True)
+    for cluster in range(n):
+        height, width = rng.integers(size[0], size[1] + 1, 2)
+        with rasterio.open(os.path.join(folder, f'{cluster}.tif'), 'w', driver='GTiff', height=height, width=width,
+                           count=bands, dtype='float32', nodata=np.nan, transform=from_origin(0, 0, 30, 30)) as dst:
+            dst.write(rng.random((bands, height, width), dtype='float32'))
+    if catalog_path:
+        TileCatalog(catalog_path).backfill(data_path)
+
+    dataset_csv = os.path.join(data_path, 'train.csv')
+    pd.DataFrame({'country': 'angola', 'year': 2010, 'cluster': np.arange(n),
+                  'iwi': rng.uniform(0, 100, n)}).to_csv(dataset_csv, index=False, sep=';')
+    return dataset_csv
@@ -0,0 +1,40 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from src import synthetic
+from src.chip_store import BatchLoader, ChipStore, pack, read_tile
+
+
+def test_pack_and_load(tmp_path):
+    data_path, output_path = str(tmp_path / 'data'), str(tmp_path / 'chips')
+    catalog_path = os.path.join(data_path, 'tile_catalog.csv')
+    dataset_csv = synthetic.write_tiles(data_path, 50, bands=3, size=(20, 24), catalog_path=catalog_path)
+    index = pack(dataset_csv, data_path, output_path, catalog_path=catalog_path)
+
+    store = ChipStore(output_path, 'train')
+    assert store.x.shape == (50, 3, 20, 20)
+    for row in range(50):
+        file_path = os.path.join(data_path, 'angola', '2010', f"{index['cluster'][row]}.tif")
+        assert np.array_equal(store.x[row], read_tile(file_path, 20))
+    assert np.allclose(store.y, index['iwi'])
+
+    for shuffle in ('batches', 'rows', None):
+        batches = list(BatchLoader(store, 16, shuffle=shuffle))
+        assert [len(y) for _, y in batches if len(y) < 16] == [2]
+        assert np.allclose(np.sort(np.concatenate([y for _, y in batches])), np.sort(store.y))
+
+
+def test_pack_without_tiles(tmp_path):
+    data_path, output_path = str(tmp_path / 'data'), str(tmp_path / 'chips')
+    catalog_path = os.path.join(data_path, 'tile_catalog.csv')
+    dataset_csv = synthetic.write_tiles(data_path, 3, bands=3, size=(20, 24), catalog_path=catalog_path)
+
+    with pytest.raises(ValueError, match='4 bands'):
+        pack(dataset_csv, data_path, output_path, bands=4, catalog_path=catalog_path)
+
+    pd.read_csv(dataset_csv, sep=';').assign(year=2011).to_csv(dataset_csv, index=False, sep=';')
+    with pytest.raises(ValueError, match='No tile'):
+        pack(dataset_csv, data_path, output_path, catalog_path=catalog_path)
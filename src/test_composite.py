@@ -0,0 +1,23 @@
+from datetime import datetime
+
+import numpy as np
+
+from src import cloud_mask, composite, synthetic, test_mosaic
+
+
+def test_tiled_median_matches_persisted_median(tmp_path):
+    dates = [datetime(2010, month, 15) for month in (2, 5, 8, 11)]
+    items = synthetic.write_scenes(str(tmp_path), dates, size=128)
+    # across the four scenes of every date
+    bbox = (synthetic.ORIGIN_LON - 0.03, synthetic.ORIGIN_LAT - 0.03,
+            synthetic.ORIGIN_LON + 0.03, synthetic.ORIGIN_LAT + 0.03)
+
+    persisted, _ = test_mosaic.compute_median(items, bbox, qa_bits=cloud_mask.QA_MASK)
+    median_memory = 1024 ** 2
+    tile = composite.tile_size((len(dates), len(synthetic.LANDSAT_BANDS)) + persisted.shape[1:], median_memory)
+    assert tile < min(persisted.shape[1:]) / 2
+
+    tiled, _ = test_mosaic.compute_median(items, bbox, median_memory=median_memory, qa_bits=cloud_mask.QA_MASK)
+    assert tiled.shape == persisted.shape
+    assert np.array_equal(tiled.values, persisted.values, equal_nan=True)
+    assert np.isfinite(tiled.values).mean() > 0.5
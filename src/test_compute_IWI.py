@@ -0,0 +1,14 @@
+import numpy as np
+
+from src.compute_IWI import score_iwi, score_iwi_rowwise
+from src.synthetic import households
+
+
+def test_score_iwi_matches_rowwise():
+    df = households(2_000)
+
+    vectorized = score_iwi(df.copy())
+    rowwise = score_iwi_rowwise(df.copy())
+
+    assert np.allclose(vectorized['IWI'], rowwise['IWI'].astype(float), rtol=0, atol=1e-9)
+    assert (vectorized.drop(columns='IWI').astype(str) == rowwise.drop(columns='IWI').astype(str)).all().all()
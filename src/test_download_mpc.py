@@ -0,0 +1,47 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+import rasterio
+from rasterio.transform import from_origin
+
+from src.tile_catalog import TileCatalog
+
+# the mosaic environment (hydra) only
+download_mpc = pytest.importorskip('src.download_mpc')
+
+INFO = {'items': 6, 'valid_fraction': 0.98, 'crs': 'EPSG:3857', 'height': 8, 'width': 8, 'dtype': 'float32'}
+
+
+def write_tile(path, bands):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with rasterio.open(path, 'w', driver='GTiff', height=8, width=8, count=bands, dtype='float32',
+                       transform=from_origin(0, 0, 30, 30)) as dst:
+        dst.write(np.zeros((bands, 8, 8), dtype='float32'))
+
+
+def test_select_landsat7(tmp_path):
+    data_path = str(tmp_path / 'data')
+    # written before the catalog, only known by their band count
+    write_tile(os.path.join(data_path, 'angola', '2010', '1.tif'), 19)
+    write_tile(os.path.join(data_path, 'angola', '2010', '2.tif'), 18)
+    catalog = TileCatalog(os.path.join(data_path, 'tile_catalog.csv'))
+    catalog.backfill(data_path)
+    catalog.add('angola', 2010, 3, dict(INFO, path='3.tif', bands=18, sensor='landsat-7+landsat-8'))
+    catalog.add('angola', 2010, 4, dict(INFO, path='4.tif', bands=19, sensor='landsat-8'))
+
+    dataset_csv, output_path = str(tmp_path / 'dataset.csv'), str(tmp_path / 'l7.csv')
+    pd.DataFrame({'country': 'angola', 'year': 2010, 'cluster': [1, 2, 3, 4, 5]}).to_csv(dataset_csv, index=False,
+                                                                                       sep=';')
+    download_mpc.select_landsat7(dataset_csv, data_path, output_path)
+    assert pd.read_csv(output_path, sep=';')['cluster'].tolist() == [1, 3]
+
+    download_mpc.extract_country_year_cluster(data_path, output_path)
+    assert pd.read_csv(output_path, sep=';')['cluster_id'].tolist() == [1, 2, 3, 4]
+
+
+def test_missing_catalog(tmp_path):
+    with pytest.raises(FileNotFoundError):
+        download_mpc.extract_country_year_cluster(str(tmp_path), str(tmp_path / 'out.csv'))
+    assert not os.listdir(tmp_path)
@@ -0,0 +1,49 @@
+import os
+
+import pandas as pd
+
+from src import label_sources
+from src.label_sources import LabelRegistry
+
+
+def normalize(df):
+    df['lat'] = df['lat'].round(1)
+    return df
+
+
+def write_source(path, lat):
+    pd.DataFrame({'lat': [lat], 'lon': [2.0]}).to_csv(path, index=False)
+
+
+def test_changed_source_replaces_its_cache(tmp_path):
+    source, cache_dir = tmp_path / 'labels.csv', tmp_path / 'cache'
+    write_source(source, 1.23)
+
+    registry = LabelRegistry(str(cache_dir))
+    registry.register('labels', str(source), normalize)
+    assert registry.frame('labels')['lat'].tolist() == [1.2]
+    first = os.listdir(cache_dir)
+
+    write_source(source, 3.46)
+    assert registry.frame('labels')['lat'].tolist() == [3.5]
+    assert len(os.listdir(cache_dir)) == 1 and os.listdir(cache_dir) != first
+
+
+def test_load_keeps_the_entry_of_another_worker(tmp_path, monkeypatch):
+    source, cache_dir = tmp_path / 'labels.csv', tmp_path / 'cache'
+    write_source(source, 1.23)
+
+    other = LabelRegistry(str(cache_dir))
+    other.register('labels', str(source), normalize)
+
+    def read_meanwhile(path):
+        # another worker writes the same key while this one reads the source
+        other.frame('labels')
+        return pd.read_csv(path)
+
+    removed = []
+    monkeypatch.setattr(label_sources.os, 'remove', removed.append)
+    registry = LabelRegistry(str(cache_dir))
+    registry.register('labels', str(source), normalize, read=read_meanwhile)
+    assert registry.frame('labels')['lat'].tolist() == [1.2]
+    assert removed == []
@@ -1,13 +1,23 @@
 import os.path
 
 import numpy as np
+import xarray as xr
 import time
+import threading
+from contextlib import contextmanager
+from functools import lru_cache
 
+import rasterio
 from rasterio import RasterioIOError
+from rasterio.warp import transform_bounds
+from rasterio.windows import from_bounds
 
 from datetime import datetime, timedelta
 
+import pystac
 import stackstac
+from dask.distributed import wait
+from stackstac.rio_reader import AutoParallelRioReader
 import pystac_client
 import planetary_computer
 
@@ -18,19 +28,98 @@ from pystac_client.stac_api_io import StacApiIO
 
 import rioxarray
 
+from src import composite, cloud_mask, tile_catalog, profiling
 
-def cloudless_mosaic(cluster_id, bbox, year, month, output_path, cloud_cover=25, time_span=2, epsg=3857):
 
-    retry = Retry(
-        total=5, backoff_factor=1, status_forcelist=[502, 503, 504], allowed_methods=None
-    )
-    stac_api_io = StacApiIO(max_retries=retry)
+PLANETARY_COMPUTER_STAC = "https://planetarycomputer.microsoft.com/api/stac/v1"
+
+
+class StacMetrics:
+    """
+    Thread-safe counters of the HTTP requests and retries issued by a
+    StacClient, and of the time spent searching and computing mosaics.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counts = {'requests': 0, 'retries': 0, 'searches': 0, 'mosaics': 0, 'scenes': 0}
+        self.seconds = {'search': 0.0, 'compute': 0.0}
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counts[name] += n
+
+    @contextmanager
+    def timer(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.seconds[stage] += time.perf_counter() - start
+
+    def summary(self):
+        with self.lock:
+            return {**self.counts, **{f'{stage}_seconds': round(t, 3) for stage, t in self.seconds.items()}}
+
+
+class CountingRetry(Retry):
+    """
+    urllib3 Retry that reports every retry to a StacMetrics instance.
+    """
+
+    def __init__(self, *args, metrics=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.metrics = metrics
+
+    def new(self, **kwargs):
+        retry = super().new(**kwargs)
+        retry.metrics = self.metrics
+        return retry
+
+    def increment(self, *args, **kwargs):
+        if self.metrics is not None:
+            self.metrics.count('retries')
+        return super().increment(*args, **kwargs)
+
+
+class StacClient:
+    """
+    STAC catalog opened once, with a pooled HTTP session shared by every
+    search. Reuse one instance across clusters instead of paying a TLS
+    handshake and a landing page fetch per cluster.
+    """
+
+    def __init__(self, url=PLANETARY_COMPUTER_STAC, modifier=planetary_computer.sign_inplace, pool_size=16):
+        self.metrics = StacMetrics()
+
+        retry = CountingRetry(
+            total=5, backoff_factor=1, status_forcelist=[502, 503, 504], allowed_methods=None,
+            metrics=self.metrics
+        )
+        stac_api_io = StacApiIO(max_retries=retry)
+
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+        stac_api_io.session.mount('http://', adapter)
+        stac_api_io.session.mount('https://', adapter)
+        stac_api_io.session.hooks['response'].append(lambda response, *args, **kwargs: self.metrics.count('requests'))
+
+        self.catalog = pystac_client.Client.open(
+            url,
+            modifier=modifier,
+            stac_io=stac_api_io
+        )
 
-    stac = pystac_client.Client.open(
-        "https://planetarycomputer.microsoft.com/api/stac/v1",
-        modifier=planetary_computer.sign_inplace,
-        stac_io=stac_api_io
-    )
+
+@lru_cache(maxsize=None)
+def get_client(url=PLANETARY_COMPUTER_STAC):
+    """
+    Process-wide StacClient for the given catalog url.
+    """
+    return StacClient(url)
+
+
+def search_items(stac, bbox, year, month, cloud_cover=25, time_span=2):
 
     # Landsat
 
@@ -38,40 +127,266 @@ def cloudless_mosaic(cluster_id, bbox, year, month, output_path, cloud_cover=25,
 
     print(f"{date_min}/{date_max}")
 
-    search = stac.search(
-        bbox=bbox,
-        datetime=f"{date_min}/{date_max}",
-        collections=["landsat-c2-l2"],
-        query={"eo:cloud_cover": {"lt": cloud_cover}},
+    with stac.metrics.timer('search'):
+        search = stac.catalog.search(
+            bbox=bbox,
+            datetime=f"{date_min}/{date_max}",
+            collections=["landsat-c2-l2"],
+            query={"eo:cloud_cover": {"lt": cloud_cover}},
+        )
+
+        items = search.item_collection()
+
+    stac.metrics.count('searches')
+
+    return items
+
+
+def stack_items(items, bbox, epsg=3857, reader=None, chunksize=4096, qa_bits=None, assets=None, dtype='float64'):
+    """
+    Lazy (time, band, y, x) stack of the items over bbox, with
+    non-positive values and, if qa_bits is given, flagged pixels as NaN.
+
+    assets: asset keys to stack, all raster assets if None. With qa_bits
+    the QA band is read for masking and left out of the stack.
+    dtype: float dtype the stack is read and computed in. stackstac only
+    rescales to float64, so other dtypes are read as digital numbers and
+    rescaled here with the raster:bands scale and offset of each asset.
+    """
+    rescale = np.dtype(dtype) == np.float64
+
+    stack_assets = assets
+    if assets is not None and qa_bits and cloud_mask.QA_BAND not in assets:
+        stack_assets = list(assets) + [cloud_mask.QA_BAND]
+
+    data = stackstac.stack(
+        items,
+        assets=stack_assets,
+        bounds_latlon=bbox,
+        chunksize=chunksize,
+        resolution=30,
+        epsg=epsg,
+        dtype=dtype,
+        fill_value=np.dtype(dtype).type(np.nan),
+        rescale=rescale,
+        errors_as_nodata=(RasterioIOError(".*"), ),
+        reader=reader or AutoParallelRioReader,
     )
 
-    items = search.item_collection()
+    if qa_bits:
+        data = cloud_mask.mask_clouds(data, qa_bits)
+        # a bit field, not a value to composite
+        data = data.drop_sel(band=cloud_mask.QA_BAND, errors='ignore')
+
+    if not rescale:
+        scale, offset = asset_scale_offset(items, data['band'].values)
+        data = data * xr.DataArray(scale.astype(dtype), dims='band') + xr.DataArray(offset.astype(dtype), dims='band')
+
+    return data.where(lambda x: x > 0, other=np.nan)
+
+
+def asset_scale_offset(items, assets):
+    """
+    raster:bands scale and offset of each asset, from the first item that
+    has it.
+    """
+    scales, offsets = [], []
+    for asset in assets:
+        raster_bands = next((item.assets[asset].extra_fields.get('raster:bands')
+                             for item in items if asset in item.assets), None) or [{}]
+        scales.append(raster_bands[0].get('scale', 1))
+        offsets.append(raster_bands[0].get('offset', 0))
+
+    return np.array(scales, dtype=float), np.array(offsets, dtype=float)
 
-    print(items[:])
 
-    data = ((
-                stackstac.stack(
-                    items,
-                    bounds_latlon=bbox,
-                    chunksize=4096,
-                    resolution=30,
-                    epsg=epsg,
-                    errors_as_nodata=(RasterioIOError(".*"), ),
-                )
-                .where(
-                    lambda x: x > 0, other=np.nan
-                )
-            ))
-
-    data = data.persist()
-
-    median = data.median(dim="time").compute()
-
-    file_name = f'{cluster_id}.tif'
-    file_path = os.path.join(output_path, file_name)
+def write_raster(median, items, file_path, output_dtype=None, cog=True):
+    """
+    Write a (band, y, x) composite of items with one band per variable.
+
+    output_dtype: dtype of the file, the composite's if None. Integer
+    dtypes store the digital numbers of the source assets, round((value -
+    offset) / scale) with the raster:bands scale and offset of each asset,
+    shifted by the dtype minimum, which is nodata. uint16 and int16 hold
+    the 16 bit Landsat bands, reflectance and temperature alike.
+    cog: write a deflate compressed, tiled Cloud Optimized GeoTIFF with
+    overviews instead of a plain GeoTIFF.
+    """
+    band_attrs = [{}] * median.sizes['band']
+    if output_dtype is not None and np.issubdtype(np.dtype(output_dtype), np.integer):
+        info = np.iinfo(output_dtype)
+        scale, offset = asset_scale_offset(items, median['band'].values)
+        numbers = (median - xr.DataArray(offset, dims='band')) / xr.DataArray(scale, dims='band')
+        median = (numbers.round() + info.min).clip(info.min + 1, info.max).fillna(info.min).astype(output_dtype)
+        band_attrs = [{'_FillValue': info.min, 'scale_factor': band_scale, 'add_offset': band_offset}
+                      for band_scale, band_offset in zip(scale, offset - info.min * scale)]
+    elif output_dtype is not None:
+        median = median.astype(output_dtype)
+        band_attrs = [{'_FillValue': np.nan}] * median.sizes['band']
+
+    options = {}
+    if cog:
+        options = {'driver': 'COG', 'compress': 'DEFLATE', 'blocksize': 256, 'overview_resampling': 'average',
+                   'predictor': 2 if np.issubdtype(median.dtype, np.integer) else 3}
+
     ds = median.to_dataset(dim='band')
+    for name, attrs in zip(ds.data_vars, band_attrs):
+        ds[name].attrs.update(attrs)
     print(ds)
-    ds.transpose('band', 'y', 'x').rio.to_raster(file_path)
+    # band is only left as a dimension by band coordinates, absent for a single band
+    ds.transpose('band', 'y', 'x', missing_dims='ignore').rio.to_raster(file_path, **options)
+
+
+def select_clear_items(items, bbox, epsg=3857, reader=None, coverage=0.95, min_clear=1, qa_bits=cloud_mask.QA_MASK):
+    """
+    Least cloudy items, by eo:cloud_cover, until `coverage` of the pixels
+    of bbox have `min_clear` clear observations according to the QA band.
+    """
+    items = sorted(items, key=lambda item: item.properties.get('eo:cloud_cover', 100))
+
+    if not any(cloud_mask.QA_BAND in item.assets for item in items):
+        return pystac.ItemCollection(items)
+
+    qa = stackstac.stack(
+        items,
+        assets=[cloud_mask.QA_BAND],
+        bounds_latlon=bbox,
+        resolution=30,
+        epsg=epsg,
+        sortby_date=False,
+        errors_as_nodata=(RasterioIOError(".*"), ),
+        reader=reader or AutoParallelRioReader,
+    ).isel(band=0)
+
+    count = cloud_mask.scenes_for_coverage(qa, coverage, min_clear, qa_bits)
+
+    return pystac.ItemCollection(items[:count])
+
+
+def compute_median(items, bbox, epsg=3857, reader=None, median_memory=None, time_batch=None, qa_bits=None,
+                   clear_coverage=None, min_clear=1, assets=None, dtype='float64', record=profiling.NULL_RECORD):
+    """
+    Median composite of the items over bbox, as a (band, y, x) DataArray
+    in memory, and the items it was computed from. See mosaic_items for
+    the options.
+    """
+    if len(items) == 0:
+        raise ValueError('No items')
+
+    with record.stage('stack'):
+        if clear_coverage:
+            items = select_clear_items(items, bbox, epsg, reader, clear_coverage, min_clear,
+                                       qa_bits or cloud_mask.QA_MASK)
+
+        stack_options = {'reader': reader, 'qa_bits': qa_bits, 'assets': assets, 'dtype': dtype}
+        data = stack_items(items, bbox, epsg, **stack_options)
+
+        if median_memory is None:
+            # reads the whole stack
+            data = data.persist()
+            if profiling.distributed_client() is not None:
+                # the workers read it in the background, persist returns at once
+                wait(data)
+        else:
+            tile = composite.tile_size(data.shape, median_memory, time_batch, data.dtype.itemsize)
+            data = stack_items(items, bbox, epsg, chunksize=tile, **stack_options)
+
+    with record.stage('compute'):
+        if median_memory is None:
+            median = data.median(dim="time").compute()
+        else:
+            # reads the stack tile by tile
+            median = composite.tiled_median(data, tile, time_batch)
+
+    return median, items
+
+
+def mosaic_items(items, cluster_id, bbox, output_path, epsg=3857, metrics=None, reader=None, median_memory=None,
+                 time_batch=None, qa_bits=None, clear_coverage=None, min_clear=1, assets=None, dtype='float64',
+                 output_dtype=None, cog=False, record=profiling.NULL_RECORD):
+    """
+    Write the median composite of the items over bbox to <cluster_id>.tif.
+
+    median_memory: bytes of stack loaded at once. None persists the whole
+    stack, otherwise the median is computed tile by tile (see composite).
+    time_batch: with median_memory, approximate the median by the median
+    of the medians of time_batch scenes at a time.
+    qa_bits: mask the pixels with these QA_PIXEL bits set (see cloud_mask).
+    clear_coverage: only composite the least cloudy items needed for this
+    fraction of pixels to have min_clear clear observations.
+    assets, dtype: bands stacked and computation dtype (see stack_items).
+    output_dtype, cog: file options (see write_raster).
+    record: profiling record timing the stack, compute and write stages.
+
+    Returns the description of the tile for the catalog (see
+    tile_catalog.describe).
+    """
+    if metrics is None:
+        metrics = StacMetrics()
+
+    with metrics.timer('compute'):
+        median, items = compute_median(items, bbox, epsg, reader, median_memory, time_batch, qa_bits,
+                                       clear_coverage, min_clear, assets, dtype, record)
+
+        file_name = f'{cluster_id}.tif'
+        file_path = os.path.join(output_path, file_name)
+        with record.stage('write'):
+            write_raster(median, items, file_path, output_dtype, cog)
+
+    metrics.count('mosaics')
+    metrics.count('scenes', len(items))
+
+    return tile_catalog.describe(median, items, file_path, epsg, output_dtype)
+
+
+def cut_chip(region_path, bbox, file_path, epsg=3857, cog=True):
+    """
+    Copy the window of a regional mosaic covering bbox (lon/lat) to
+    file_path, on the same pixel grid stack_items would give the bbox
+    alone. Returns the chip as a float (band, y, x) array, NaN where
+    there is no data.
+    """
+    bounds = transform_bounds('EPSG:4326', f'EPSG:{epsg}', *bbox)
+
+    with rasterio.open(region_path) as src:
+        resolution = src.res[0]
+        # snapped outwards to the resolution like stackstac does
+        bounds = (np.floor(bounds[0] / resolution) * resolution, np.floor(bounds[1] / resolution) * resolution,
+                  np.ceil(bounds[2] / resolution) * resolution, np.ceil(bounds[3] / resolution) * resolution)
+        window = from_bounds(*bounds, transform=src.transform).round_offsets().round_lengths()
+
+        data = src.read(window=window, boundless=True, fill_value=src.nodata)
+        profile = src.profile.copy()
+        profile.update(width=window.width, height=window.height, transform=src.window_transform(window))
+        if cog:
+            profile.update(driver='COG', blocksize=256, overview_resampling='average')
+            for key in ['blockxsize', 'blockysize', 'tiled', 'interleave']:
+                profile.pop(key, None)
+
+        with rasterio.open(file_path, 'w', **profile) as dst:
+            dst.write(data)
+            dst.descriptions = src.descriptions
+            dst.scales = src.scales
+            dst.offsets = src.offsets
+            for band in range(1, src.count + 1):
+                dst.update_tags(band, **src.tags(band))
+
+    chip = data.astype('float64') * np.array(src.scales)[:, None, None] + np.array(src.offsets)[:, None, None]
+    if src.nodata is not None and not np.isnan(src.nodata):
+        chip[data == src.nodata] = np.nan
+    return chip
+
+
+def cloudless_mosaic(cluster_id, bbox, year, month, output_path, cloud_cover=25, time_span=2, epsg=3857, stac=None):
+
+    if stac is None:
+        stac = get_client()
+
+    items = search_items(stac, bbox, year, month, cloud_cover, time_span)
+
+    print(items[:])
+
+    mosaic_items(items, cluster_id, bbox, output_path, epsg, stac.metrics)
 
     return items
 
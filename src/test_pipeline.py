@@ -0,0 +1,82 @@
+import os
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+import pytest
+import rasterio
+
+from src import cloud_mask, pipeline, scheduler, synthetic, test_mosaic, tile_catalog
+from src.store import to_bbox_columns
+from src.utils import areas_of_interest
+
+CLUSTERS = 6
+
+
+@pytest.fixture(scope='module')
+def stac_url(tmp_path_factory):
+    dates = [datetime(2010, month, 15) for month in (2, 5, 8, 11)]
+    items = synthetic.write_scenes(str(tmp_path_factory.mktemp('scenes')), dates, size=256)
+    with synthetic.LocalStac(items) as stac:
+        yield stac.url
+
+
+def run(run_mosaics, directory, stac_url, **options):
+    """
+    Mosaics of the synthetic clusters written under directory by
+    run_mosaics. Returns the ledger counts and the tiles by cluster id.
+    """
+    lats, lons = synthetic.cluster_locations(CLUSTERS)
+    df = to_bbox_columns(pd.DataFrame({'country': 'angola', 'year': 2010, 'month': 6,
+                                       'cluster_id': np.arange(CLUSTERS), 'lat': lats, 'lon': lons,
+                                       'area_of_interest': areas_of_interest(lats, lons, 2).tolist()}))
+
+    ledger = scheduler.JobLedger(os.path.join(directory, 'ledger.csv'))
+    catalog = tile_catalog.TileCatalog(os.path.join(directory, 'catalog.csv'))
+    tasks = scheduler.plan_tasks(df, os.path.join(directory, 'data'), ledger)
+    counts = run_mosaics(tasks, ledger, stac=test_mosaic.StacClient(stac_url, modifier=None), catalog=catalog,
+                         cache_dir=os.path.join(directory, 'cache'), cache_bytes=1024 ** 3,
+                         qa_bits=cloud_mask.QA_MASK, dtype='float32', output_dtype='int16', cog=True, **options)
+
+    tiles = {}
+    for cluster_id in range(CLUSTERS):
+        with rasterio.open(os.path.join(directory, 'data', 'angola', '2010', f'{cluster_id}.tif')) as src:
+            tiles[cluster_id] = src.read()
+    assert len(catalog.table()) == CLUSTERS
+
+    return counts, tiles
+
+
+def transforms(directory):
+    transforms = {}
+    for cluster_id in range(CLUSTERS):
+        with rasterio.open(os.path.join(directory, 'data', 'angola', '2010', f'{cluster_id}.tif')) as src:
+            transforms[cluster_id] = src.transform
+    return transforms
+
+
+def test_pipeline_matches_scheduler(tmp_path, stac_url):
+    counts, scheduled = run(scheduler.run_mosaics, str(tmp_path / 'scheduled'), stac_url)
+    assert counts[scheduler.DONE] == CLUSTERS
+
+    counts, pipelined = run(pipeline.run_pipeline, str(tmp_path / 'pipelined'), stac_url)
+    assert counts[scheduler.DONE] == CLUSTERS
+
+    for cluster_id in range(CLUSTERS):
+        # the QA band is only used for masking
+        assert scheduled[cluster_id].shape[0] == len(synthetic.LANDSAT_BANDS)
+        assert np.array_equal(scheduled[cluster_id], pipelined[cluster_id])
+
+
+@pytest.mark.parametrize('keep_regions', [False, True])
+def test_chips_match_cluster_tiles(tmp_path, stac_url, keep_regions):
+    clusters, region_dir = str(tmp_path / 'clusters'), str(tmp_path / 'regions')
+    _, tiles = run(scheduler.run_mosaics, clusters, stac_url)
+    counts, chips = run(scheduler.run_mosaics, str(tmp_path / 'chips'), stac_url, chips=True,
+                        region_dir=region_dir, keep_regions=keep_regions)
+    assert counts[scheduler.DONE] == CLUSTERS
+
+    assert transforms(str(tmp_path / 'chips')) == transforms(clusters)
+    for cluster_id in range(CLUSTERS):
+        assert np.array_equal(chips[cluster_id], tiles[cluster_id])
+    assert bool(os.listdir(region_dir)) == keep_regions
@@ -0,0 +1,24 @@
+import numpy as np
+import pandas as pd
+
+from src.process_IWI import number_missing_clusters, number_missing_clusters_rowwise
+
+
+def test_number_missing_clusters():
+    cluster_ids = pd.Series([np.nan, np.nan, 5, np.nan, 7, 7, np.nan, np.nan, np.nan], name='cluster_id')
+
+    numbered = number_missing_clusters(cluster_ids)
+    assert numbered.tolist() == [0, 1, 5, 0, 7, 7, 0, 1, 2]
+    assert numbered.name == 'cluster_id'
+
+
+def test_number_missing_clusters_matches_rowwise():
+    rng = np.random.default_rng(0)
+    ids = rng.integers(1, 1000, 10_000).astype(float)
+    ids[rng.random(len(ids)) < 0.5] = np.nan
+    ids[:3] = ids[-3:] = np.nan
+    cluster_ids = pd.Series(ids, index=rng.permutation(len(ids)), name='cluster_id')
+
+    numbered = number_missing_clusters(cluster_ids)
+    assert numbered.equals(number_missing_clusters_rowwise(cluster_ids))
+    assert numbered.notna().all()
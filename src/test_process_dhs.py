@@ -0,0 +1,48 @@
+import os
+
+import process_dhs
+
+
+def fake_survey(folder_path, country, year, buffer=5, csv=False, profile=None):
+    if country == 'chad':
+        # a worker killed by the system, e.g. when out of memory
+        os._exit(1)
+    return {'key': f'{country}/{year}', 'status': 'skipped', 'output': None, 'rows': 0, 'error': None,
+            'seconds': 0.0}
+
+
+def test_dead_worker_fails_its_survey_only(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    countries = ['angola', 'benin', 'chad', 'gabon', 'kenya', 'mali']
+    for country in countries:
+        os.makedirs(os.path.join('data', country, '2010'))
+    monkeypatch.setattr(process_dhs, 'process_survey', fake_survey)
+
+    results = process_dhs.process_all_dhs_files(workers=2)
+
+    assert [result['key'] for result in results] == [f'{country}/2010' for country in countries]
+    failed = [result['key'] for result in results if result['status'] == 'failed']
+    # the survey run next to it in the dying pool may fail with it
+    assert 'chad/2010' in failed and len(failed) <= 2
+
+
+def write_survey(folder_path, country, year, buffer=5, csv=False, profile=None):
+    output = os.path.join('data', 'dhs_month', f'{country}_{year}.parquet')
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    for path in [output] + ([output.replace('.parquet', '.csv')] if csv else []):
+        open(path, 'w').close()
+    return {'key': f'{country}/{year}', 'status': 'done', 'output': output, 'rows': 1, 'error': None,
+            'seconds': 0.0}
+
+
+def test_csv_run_exports_processed_surveys(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    os.makedirs(os.path.join('data', 'angola', '2010'))
+    monkeypatch.setattr(process_dhs, 'process_survey', write_survey)
+
+    assert len(process_dhs.process_all_dhs_files()) == 1
+    assert process_dhs.process_all_dhs_files() == []
+
+    assert len(process_dhs.process_all_dhs_files(csv=True)) == 1
+    assert os.path.exists(os.path.join('data', 'dhs_month', 'angola_2010.csv'))
+    assert process_dhs.process_all_dhs_files(csv=True) == []
@@ -0,0 +1,59 @@
+import json
+from functools import partial
+
+import numpy as np
+from distributed import Client, LocalCluster
+
+from src import profiling
+
+
+def read_input(path):
+    with open(path, 'rb') as f:
+        return len(f.read())
+
+
+def test_stage_counts_the_workers(tmp_path):
+    data = tmp_path / 'data.bin'
+    data.write_bytes(np.random.default_rng(0).bytes(8 * 1024 ** 2))
+    path = str(tmp_path / 'profile.jsonl')
+
+    with LocalCluster(n_workers=1, threads_per_worker=1, processes=True, dashboard_address=None) as cluster, \
+            Client(cluster) as client:
+        record = profiling.Profiler(path).record('test')
+        with record.stage('read'):
+            # read by the worker process only
+            assert client.submit(read_input, str(data)).result() == 8 * 1024 ** 2
+        record.emit()
+
+    with open(path) as f:
+        stage = json.loads(f.readline())['stages']['read']
+    assert stage['disk_bytes_read'] >= 8 * 1024 ** 2
+
+
+def test_in_process_workers_are_counted_once():
+    with LocalCluster(n_workers=2, processes=False, dashboard_address=None) as cluster, Client(cluster):
+        read, _, peak = profiling.counters()
+    assert read is not None and read <= profiling.disk_bytes_read()
+    assert peak == profiling.peak_rss_mb()
+
+
+NET_DEV = """Inter-|   Receive                                                |  Transmit
+ face |bytes    packets errs drop fifo frame compressed multicast|bytes    packets errs drop fifo colls carrier compressed
+    lo: 5000   10    0    0    0     0          0         0 5000   10    0    0    0     0       0          0
+  eth0:{}   20    0    0    0     0          0         0 300   3    0    0    0     0       0          0
+"""
+
+
+def test_stage_counts_the_network(tmp_path, monkeypatch):
+    net_dev = tmp_path / 'dev'
+    net_dev.write_text(NET_DEV.format(1000))
+    # loopback traffic (dask, local servers) is not network
+    assert profiling.net_bytes_recv(str(net_dev)) == 1000
+    monkeypatch.setattr(profiling, 'net_bytes_recv', partial(profiling.net_bytes_recv, str(net_dev)))
+
+    record = profiling.Record(profiling.Profiler(), 'test', {})
+    with record.stage('search'):
+        net_dev.write_text(NET_DEV.format(5000))
+    with record.stage('search'):
+        net_dev.write_text(NET_DEV.format(7000))
+    assert record.stages['search']['net_bytes_recv'] == 6000
@@ -0,0 +1,55 @@
+import numpy as np
+import pytest
+import rasterio
+from rasterio import RasterioIOError
+from rasterio.enums import Resampling
+from rasterio.transform import from_origin
+from rasterio.windows import Window
+from stackstac.raster_spec import RasterSpec
+from stackstac.rio_reader import DEFAULT_GDAL_ENV
+
+from src.read_cache import BlockCache, CachedRioReader
+
+SIZE = 1024
+
+
+def open_reader(url, cache_dir, errors_as_nodata=()):
+    spec = RasterSpec(epsg=3857, bounds=(0, 0, SIZE * 30, SIZE * 30), resolutions_xy=(30, 30))
+    return CachedRioReader(url=url, spec=spec, resampling=Resampling.nearest, dtype='float64', fill_value=np.nan,
+                           scale_offset=(1, 0), gdal_env=DEFAULT_GDAL_ENV, errors_as_nodata=errors_as_nodata,
+                           cache_dir=cache_dir, max_bytes=1024 ** 3, block_size=512)
+
+
+def test_block_cache_overwrite_keeps_size(tmp_path):
+    cache = BlockCache(str(tmp_path), 1024 ** 3)
+    cache.put('block', np.zeros((64, 64)))
+    size = cache.size
+    cache.put('block', np.ones((64, 64)))
+    assert cache.size == size == BlockCache(str(tmp_path), 1024 ** 3).size
+
+
+def test_cached_read_matches_file(tmp_path):
+    path = str(tmp_path / 'scene.tif')
+    data = np.random.default_rng(0).random((SIZE, SIZE))
+    with rasterio.open(path, 'w', driver='GTiff', height=SIZE, width=SIZE, count=1, dtype='float64',
+                       crs='EPSG:3857', transform=from_origin(0, SIZE * 30, 30, 30)) as dst:
+        dst.write(data, 1)
+
+    window = Window(300, 200, 400, 500)
+    block = open_reader(path, str(tmp_path / 'cache')).read(window)
+    assert np.array_equal(block, data[200:700, 300:700])
+    assert len(list((tmp_path / 'cache').iterdir())) == 4
+
+    # served from the cache
+    assert np.array_equal(open_reader(path, str(tmp_path / 'cache')).read(window), block)
+
+
+def test_failed_reads_are_not_cached(tmp_path):
+    missing = str(tmp_path / 'missing.tif')
+
+    block = open_reader(missing, str(tmp_path / 'cache'), (RasterioIOError('.*'),)).read(Window(0, 0, 100, 100))
+    assert block.shape == (100, 100) and np.isnan(block).all()
+    assert list((tmp_path / 'cache').iterdir()) == []
+
+    with pytest.raises(RuntimeError):
+        open_reader(missing, str(tmp_path / 'cache')).read(Window(0, 0, 100, 100))
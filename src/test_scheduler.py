@@ -0,0 +1,39 @@
+from src.scheduler import JobLedger, PENDING, DONE, FAILED
+
+
+def write_ledger(path, lines):
+    path.write_text('country;year;cluster_id;status;attempts;items;error\r\n' + lines)
+
+
+def test_ledger_last_line_wins(tmp_path):
+    path = tmp_path / 'ledger.csv'
+    ledger = JobLedger(str(path))
+    ledger.register([('angola', 2010, 1, PENDING), ('angola', 2010, 2, PENDING)])
+    ledger.mark('angola', 2010, 1, FAILED, error='timeout\nretry')
+    ledger.mark('angola', 2010, 1, DONE, items=4)
+
+    ledger = JobLedger(str(path))
+    assert ledger.status('angola', 2010, 1) == DONE
+    assert ledger.jobs[ledger.key('angola', 2010, 1)]['attempts'] == 2
+    assert ledger.counts() == {PENDING: 1, DONE: 1, FAILED: 0}
+
+
+def test_ledger_skips_truncated_lines(tmp_path):
+    path = tmp_path / 'ledger.csv'
+    write_ledger(path, 'angola;2010;1;pending;0;;\r\n'
+                       'angola;2010;2;pending;0;;\r\n'
+                       'angola;2010;1;done;1;4;\r\n'
+                       # cut after the status, then inside it
+                       'angola;2010;2;done\r\n'
+                       'angola;2010;1;fai')
+
+    ledger = JobLedger(str(path))
+    assert ledger.status('angola', 2010, 1) == DONE
+    assert ledger.status('angola', 2010, 2) == PENDING
+    assert ledger.counts() == {PENDING: 1, DONE: 1, FAILED: 0}
+
+    # the next line doesn't run into the truncated one
+    ledger.mark('angola', 2010, 2, FAILED, error='No items')
+    ledger = JobLedger(str(path))
+    assert ledger.status('angola', 2010, 2) == FAILED
+    assert ledger.status('angola', 2010, 1) == DONE
@@ -0,0 +1,51 @@
+from datetime import datetime
+
+import pystac
+from shapely import box
+from shapely.geometry import mapping
+
+from src.search_planner import assign_items, plan_searches
+
+
+def task(cluster_id, bbox, country='angola', year=2010, month=6):
+    return {'country': country, 'year': year, 'month': month, 'cluster_id': cluster_id, 'bbox': bbox}
+
+
+def item(item_id, bbox, date):
+    return pystac.Item(item_id, mapping(box(*bbox)), bbox, datetime.strptime(date, '%Y-%m-%d'), {})
+
+
+TASKS = [task(0, (13.0, -12.5, 13.1, -12.4)),
+         task(1, (14.0, -12.2, 14.1, -12.1)),
+         # another time window
+         task(2, (13.3, -13.0, 13.4, -12.9), month=1),
+         task(3, (13.0, -12.5, 13.1, -12.4), year=2012),
+         task(4, (13.0, -12.5, 13.1, -12.4), country='zambia'),
+         # another 5 degree cell
+         task(5, (20.0, -12.5, 20.1, -12.4))]
+
+
+def test_plan_groups_by_country_year_and_cell():
+    groups = plan_searches(TASKS)
+    assert [[task['cluster_id'] for task in group['tasks']] for group in groups] == [[0, 1, 2], [3], [4], [5]]
+
+    group = groups[0]
+    assert group['bbox'] == (13.0, -13.0, 14.1, -12.1)
+    assert group['windows'] == [('2009-06-01', '2011-06-01')] * 2 + [('2009-01-01', '2011-01-01')]
+    assert group['datetime'] == ('2009-01-01', '2011-06-01')
+
+    groups = plan_searches(TASKS, split_windows=True)
+    assert [[task['cluster_id'] for task in group['tasks']] for group in groups] == [[0, 1], [2], [3], [4], [5]]
+    assert groups[0]['datetime'] == ('2009-06-01', '2011-06-01')
+
+
+def test_assign_items_by_footprint_and_date():
+    group = plan_searches(TASKS)[0]
+    # late is after every time window, none intersects the third box
+    items = [item('late', (12.9, -12.6, 14.2, -12.0), '2011-09-01'),
+             item('both', (12.9, -12.6, 14.2, -12.0), '2010-02-01'),
+             item('first', (12.9, -12.6, 13.2, -12.3), '2009-08-01'),
+             item('second', (13.9, -12.3, 14.2, -12.0), '2011-03-01')]
+
+    assigned = assign_items(items, group)
+    assert [[item.id for item in task_items] for task_items in assigned] == [['both', 'first'], ['both', 'second'], []]
@@ -0,0 +1,25 @@
+import numpy as np
+import pandas as pd
+
+from src.spatial_join import spatial_join, spatial_drop_duplicates
+
+
+def test_join_leaves_rows_without_coordinates_unmatched():
+    left = pd.DataFrame({'lat': [-12.3, np.nan, -12.5], 'lon': [13.5, 13.6, np.nan], 'id': [1, 2, 3]})
+    right = pd.DataFrame({'lat': [np.nan, -12.30001], 'lon': [13.6, 13.50001], 'iwi': [10.0, 20.0]})
+
+    inner = spatial_join(left, right)
+    assert inner['id'].tolist() == [1] and inner['iwi'].tolist() == [20.0]
+
+    joined = spatial_join(left, right, how='left')
+    assert joined['id'].tolist() == [1, 2, 3]
+    assert joined['iwi'].tolist()[0] == 20.0 and joined['iwi'].iloc[1:].isna().all()
+    assert joined['distance_km'].iloc[1:].isna().all()
+
+
+def test_drop_duplicates_keeps_rows_without_coordinates():
+    df = pd.DataFrame({'lat': [np.nan, -12.3, np.nan, -12.30001, -12.4],
+                       'lon': [13.5, 13.5, np.nan, 13.50001, 13.5]})
+
+    assert spatial_drop_duplicates(df).index.tolist() == [0, 1, 2, 4]
+    assert spatial_drop_duplicates(df.iloc[[0, 2]]).index.tolist() == [0, 2]
@@ -0,0 +1,49 @@
+import numpy as np
+import pandas as pd
+
+from src import splits
+
+
+def write_dataset(path, n, seed=0):
+    rng = np.random.default_rng(seed)
+    pd.DataFrame({'country': rng.choice(['angola', 'benin', 'chad'], n), 'year': 2010, 'cluster': np.arange(n),
+                  'lat': rng.uniform(-30, 10, n).round(6), 'lon': rng.uniform(0, 40, n).round(6),
+                  'iwi': rng.beta(2, 5, n) * 100}).to_csv(path, index=False, sep=';')
+
+
+def test_train_test_split(tmp_path):
+    dataset_csv = str(tmp_path / 'dataset.csv')
+    write_dataset(dataset_csv, 50_000)
+
+    summary = splits.train_test_split(dataset_csv, str(tmp_path / 'a'), 0.8)
+    train, test = (pd.read_csv(tmp_path / 'a' / f'{name}.csv', sep=';') for name in ['train', 'test'])
+    assert len(train) + len(test) == 50_000
+    assert summary['rows'].tolist() == [len(train), len(test)]
+
+    # no block on both sides
+    blocks = [set(map(tuple, splits.block_index(df).values.tolist())) for df in (train, test)]
+    assert not blocks[0] & blocks[1]
+
+    # every populated label bin split 80/20
+    shares = summary.filter(like='bin_') / summary.filter(like='bin_').sum()
+    assert (shares.loc['train'].iloc[:4] - 0.8).abs().max() < 0.02
+
+
+def test_split_is_reproducible_whatever_the_chunks(tmp_path):
+    dataset_csv = str(tmp_path / 'dataset.csv')
+    write_dataset(dataset_csv, 10_000)
+
+    splits.train_test_split(dataset_csv, str(tmp_path / 'a'), 0.8, seed=3)
+    splits.train_test_split(dataset_csv, str(tmp_path / 'b'), 0.8, seed=3, chunksize=1_500)
+    for name in ['train', 'test']:
+        assert (tmp_path / 'a' / f'{name}.csv').read_text() == (tmp_path / 'b' / f'{name}.csv').read_text()
+
+
+def test_k_fold_split_without_rows(tmp_path):
+    dataset_csv = str(tmp_path / 'dataset.csv')
+    write_dataset(dataset_csv, 2)
+
+    summary = splits.k_fold_split(dataset_csv, str(tmp_path / 'folds'), k=3, block_size=None)
+    assert summary['rows'].sum() == 2
+    for n in range(3):
+        assert pd.read_csv(tmp_path / 'folds' / f'fold_{n}.csv', sep=';').columns.tolist()[0] == 'country'
@@ -0,0 +1,28 @@
+from src.tile_catalog import TileCatalog
+
+INFO = {'path': 'data/angola/2010/1.tif', 'bands': 4, 'sensor': 'landsat-7+landsat-8', 'items': 6,
+        'valid_fraction': 0.98, 'crs': 'EPSG:3857', 'height': 334, 'width': 334, 'dtype': 'int16'}
+
+
+def test_catalog_last_line_wins(tmp_path):
+    path = str(tmp_path / 'catalog.csv')
+    TileCatalog(path).add('angola', 2010, 1, dict(INFO, items=3))
+    TileCatalog(path).add('angola', 2010, 1, INFO)
+
+    table = TileCatalog(path).table()
+    assert len(table) == 1 and table['items'].tolist() == [6] and table['sensor'].tolist() == [INFO['sensor']]
+
+
+def test_catalog_skips_truncated_lines(tmp_path):
+    path = tmp_path / 'catalog.csv'
+    catalog = TileCatalog(str(path))
+    catalog.add('angola', 2010, 1, INFO)
+    with open(path, 'a') as f:
+        f.write('angola;2010;2;data/angola/2010/2.tif;4;landsat-7')
+
+    catalog = TileCatalog(str(path))
+    assert list(catalog.tiles) == [('angola', '2010', '1')]
+
+    # the next line doesn't run into the truncated one
+    catalog.add('angola', 2010, 2, INFO)
+    assert list(TileCatalog(str(path)).tiles) == [('angola', '2010', '1'), ('angola', '2010', '2')]
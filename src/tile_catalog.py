@@ -0,0 +1,150 @@
+import os
+import argparse
+import threading
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+import rasterio
+
+from src import append_log
+
+
+# Index of the cluster tiles written by the mosaics, so selecting tiles
+# by sensor or band count doesn't require opening every GeoTIFF.
+
+CATALOG_COLUMNS = ['country', 'year', 'cluster_id', 'path', 'bands', 'sensor', 'items', 'valid_fraction', 'crs',
+                   'height', 'width', 'dtype', 'written']
+
+
+def describe(median, items, file_path, epsg, dtype=None):
+    """
+    Catalog fields of a (band, y, x) composite of items written to
+    file_path. sensor lists the platforms of the items, e.g.
+    'landsat-7+landsat-8', valid_fraction is the fraction of pixels with
+    a value in every band. dtype is the file's, if it differs from the
+    composite's.
+    """
+    values = np.asarray(median)
+    if values.ndim == 2:
+        values = values[np.newaxis]
+
+    platforms = sorted({item.properties.get('platform', '') for item in items} - {''})
+
+    return {'path': file_path,
+            'bands': values.shape[0],
+            'sensor': '+'.join(platforms),
+            'items': len(items),
+            'valid_fraction': round(float(np.isfinite(values).all(axis=0).mean()), 4),
+            'crs': f'EPSG:{epsg}',
+            'height': values.shape[1],
+            'width': values.shape[2],
+            'dtype': str(np.dtype(dtype or values.dtype))}
+
+
+def describe_file(file_path):
+    """
+    Catalog fields of a tile written before the catalog existed, from
+    its header only. sensor, items and valid_fraction are unknown.
+    """
+    with rasterio.open(file_path) as src:
+        return {'path': file_path,
+                'bands': src.count,
+                'sensor': '',
+                'items': '',
+                'valid_fraction': '',
+                'crs': src.crs.to_string() if src.crs else '',
+                'height': src.height,
+                'width': src.width,
+                'dtype': src.dtypes[0]}
+
+
+class TileCatalog:
+    """
+    Append-only ';' separated table of the tiles, one line per tile
+    written. The last line of a tile wins, like the JobLedger, so tiles
+    can be added concurrently by the mosaic workers.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.tiles = {}
+        self.lock = threading.Lock()
+
+        for row in append_log.load(path, CATALOG_COLUMNS, self.parse):
+            self.tiles[self.key(row['country'], row['year'], row['cluster_id'])] = row
+
+    @staticmethod
+    def key(country, year, cluster_id):
+        return str(country), str(year), str(cluster_id)
+
+    @staticmethod
+    def parse(row):
+        # a line cut short by a crash before its timestamp
+        return row if row['written'] else None
+
+    def _append(self, rows):
+        append_log.append(self.path, CATALOG_COLUMNS, rows)
+
+    def add(self, country, year, cluster_id, info):
+        """
+        Record the tile of a cluster described by info (see describe).
+        """
+        key = self.key(country, year, cluster_id)
+        row = {'country': key[0], 'year': key[1], 'cluster_id': key[2], **info,
+               'written': datetime.now().isoformat(timespec='seconds')}
+        with self.lock:
+            self.tiles[key] = row
+            self._append([row])
+
+    def backfill(self, data_path):
+        """
+        Add the data_path/<country>/<year>/<cluster_id>.tif tiles missing
+        from the catalog, reading their header only. Returns the number of
+        tiles added.
+        """
+        rows = []
+        for country in sorted(os.listdir(data_path)):
+            country_path = os.path.join(data_path, country)
+            if not os.path.isdir(country_path):
+                continue
+            for year in sorted(os.listdir(country_path)):
+                year_path = os.path.join(country_path, year)
+                if not os.path.isdir(year_path):
+                    continue
+                for file_name in sorted(os.listdir(year_path)):
+                    cluster_id = file_name[:-len('.tif')]
+                    if not file_name.endswith('.tif') or self.key(country, year, cluster_id) in self.tiles:
+                        continue
+                    row = {'country': country, 'year': year, 'cluster_id': cluster_id,
+                           **describe_file(os.path.join(year_path, file_name)),
+                           'written': datetime.now().isoformat(timespec='seconds')}
+                    rows.append(row)
+
+        with self.lock:
+            for row in rows:
+                self.tiles[self.key(row['country'], row['year'], row['cluster_id'])] = row
+            if rows:
+                self._append(rows)
+
+        return len(rows)
+
+    def table(self):
+        """
+        Current state of every tile as a dataframe, one row per tile.
+        """
+        df = pd.DataFrame(list(self.tiles.values()), columns=CATALOG_COLUMNS)
+        for column in ['year', 'cluster_id', 'bands', 'items', 'valid_fraction', 'height', 'width']:
+            # empty for the fields describe_file can't know
+            df[column] = pd.to_numeric(df[column], errors='coerce')
+        return df
+
+
+if __name__ == '__main__':
+    # one-off migration: add the tiles written before the catalog existed
+    parser = argparse.ArgumentParser()
+    parser.add_argument('data_path', nargs='?', default='data', help='folder of the <country>/<year> tile folders')
+    parser.add_argument('--catalog', default='data/tile_catalog.csv', help='catalog file')
+    args = parser.parse_args()
+
+    print(f'Added {TileCatalog(args.catalog).backfill(args.data_path)} tiles to {args.catalog}')
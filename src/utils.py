@@ -1,14 +1,16 @@
 import os
 import glob
-from functools import partial
 
 import pyproj
 import numpy as np
 import rasterio as rio
 import scipy.ndimage as nd
 from PIL import Image
-from shapely.geometry import Point
-from shapely.ops import transform
+
+
+# vertex angles of the 64-segment circle shapely draws for Point.buffer
+BUFFER_ANGLES = np.linspace(0, 2 * np.pi, 64, endpoint=False)
+GEOD = pyproj.Geod(ellps='WGS84')
 
 
 def area_of_interest(lat, lon, km):
@@ -16,16 +18,39 @@ def area_of_interest(lat, lon, km):
     Generate a buffer around a location (lat, long). Returns
     the geometry corresponding to its spatial envelope.
     """
-    proj_wgs84 = pyproj.Proj('+proj=longlat +datum=WGS84')
-    aeqd_proj = '+proj=aeqd +lat_0={lat} +lon_0={lon} +x_0=0 +y_0=0'
-    project = partial(
-        pyproj.transform,
-        pyproj.Proj(aeqd_proj.format(lat=lat, lon=lon)),
-        proj_wgs84)
-    buf = Point(lat, lon).buffer(km * 1000)
-    aoi = transform(project, buf).exterior.envelope
-    xmin, ymin, xmax, ymax = [round(coord, 3) for coord in aoi.bounds]
-    return [xmin, ymin, xmax, ymax]
+    return areas_of_interest([lat], [lon], km)[0].tolist()
+
+
+def areas_of_interest(lats, lons, km):
+    """
+    Vectorized version of area_of_interest. Returns an (N, 4) array
+    of [xmin, ymin, xmax, ymax] envelopes rounded to 3 decimals.
+
+    The buffer is built in an azimuthal equidistant projection centered
+    on each cluster, which is the geodesic of the given azimuth and
+    distance from the center, so every vertex is moved with a single
+    Geod.fwd call instead of one pyproj transform per cluster.
+    """
+    lats = np.asarray(lats, dtype=float).reshape(-1, 1)
+    lons = np.asarray(lons, dtype=float).reshape(-1, 1)
+
+    # the buffered point is Point(lat, lon) in aeqd metres, keep it as is
+    # so the envelopes stay identical to the per-row implementation
+    x = lats + km * 1000 * np.cos(BUFFER_ANGLES)
+    y = lons + km * 1000 * np.sin(BUFFER_ANGLES)
+
+    lon0 = np.broadcast_to(lons, x.shape).ravel()
+    lat0 = np.broadcast_to(lats, x.shape).ravel()
+    azimuth = np.degrees(np.arctan2(x, y)).ravel()
+    distance = np.hypot(x, y).ravel()
+
+    vertex_lon, vertex_lat, _ = GEOD.fwd(lon0, lat0, azimuth, distance)
+    vertex_lon = vertex_lon.reshape(x.shape)
+    vertex_lat = vertex_lat.reshape(x.shape)
+
+    bounds = np.column_stack([vertex_lon.min(axis=1), vertex_lat.min(axis=1),
+                              vertex_lon.max(axis=1), vertex_lat.max(axis=1)])
+    return np.round(bounds, 3)
 
 
 def fill(arr):